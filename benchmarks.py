@@ -0,0 +1,651 @@
+#!/usr/bin/env python
+""" Offline benchmarks for the recommendation loop, run against a local stand-in for the Last.fm API """
+import BaseHTTPServer
+import SocketServer
+import gc
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+import blackboard
+
+
+class StubCatalog(object):
+    """ A deterministic, synthetic music catalog shaped like the Last.fm API responses """
+    def __init__(self, artists=500, seed=0):
+        self.artists = artists
+        self.seed = seed
+
+    def _artist_number(self, artist):
+        digits = ''.join(c for c in artist if c.isdigit())
+        return int(digits) % self.artists if digits else 0
+
+    def artist(self, number):
+        return 'Artist %d' % (number % self.artists)
+
+    def track(self, artist):
+        return 'Song of %s' % artist
+
+    def respond(self, params):
+        method = params.get('method')
+        artist = params.get('artist', '')
+        number = self._artist_number(artist)
+        rand = random.Random('%s/%s/%s' % (self.seed, artist, params.get('track')))
+        if method == 'track.getInfo':
+            track = params.get('track', '')
+            return {'track': {'name': track,
+                              'artist': {'name': artist, 'url': 'http://www.last.fm/music/%s' % artist},
+                              'url': 'http://www.last.fm/music/%s/_/%s' % (artist, track),
+                              'playcount': str(rand.randint(1, 1000000)),
+                              'listeners': str(rand.randint(1, 100000)),
+                              'duration': str(rand.randint(120000, 360000)),
+                              'album': {'image': [{'size': size, '#text': 'http://img/%s' % size}
+                                                  for size in ('small', 'medium', 'large')]},
+                              'toptags': {'tag': [{'name': 'tag%d' % rand.randint(0, 60)}
+                                                  for _ in range(5)]},
+                              'wiki': {'summary': 'x' * 300, 'content': 'x' * 1500}}}
+        if method == 'artist.getSimilar':
+            limit = int(params.get('limit', 20))
+            return {'similarartists': {'artist': [{'name': self.artist(number + offset)}
+                                                  for offset in range(1, limit + 1)]}}
+        if method == 'artist.getTopTracks':
+            return {'toptracks': {'track': {'name': self.track(artist),
+                                            'artist': {'name': artist}}}}
+        if method == 'track.getTopTags':
+            return {'toptags': {'tag': [{'name': 'tag%d' % rand.randint(0, 60)}
+                                        for _ in range(25)]}}
+        return {'error': 3, 'message': 'Invalid Method'}
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server
+        fault = stub.next_fault()
+        if stub.latency:
+            time.sleep(stub.latency)
+        status = 200
+        if fault == 'stall':
+            time.sleep(stub.stall)
+        if fault == 'unavailable':
+            status, response = 503, {'error': 16, 'message': 'Service temporarily unavailable'}
+        elif fault == 'throttled':
+            status, response = 429, {'error': 29, 'message': 'Rate limit exceeded'}
+        elif fault == 'rate limit':
+            # Last.fm also reports errors in the body of a 200 response
+            response = {'error': 29, 'message': 'Rate limit exceeded'}
+        else:
+            params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+            response = stub.catalog.respond(params)
+        body = json.dumps(response)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local stand-in for ws.audioscrobbler.com with a fixed latency per request
+
+    A faults fraction of requests fail with a 503, a 429 or a rate limit error in a 200
+    response, and a stalls fraction are held for stall seconds before being answered.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+    FAULTS = ('unavailable', 'throttled', 'rate limit')
+
+    def __init__(self, latency=0.0, catalog=None, faults=0.0, stalls=0.0, stall=1.0, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.catalog = catalog or StubCatalog()
+        self.faults = faults
+        self.stalls = stalls
+        self.stall = stall
+        self.requests = 0
+        self.injected = 0
+        self.lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def next_fault(self):
+        with self.lock:
+            self.requests += 1
+            roll = self._random.random()
+            if roll < self.stalls:
+                fault = 'stall'
+            elif roll < self.stalls + self.faults:
+                fault = self._random.choice(self.FAULTS)
+            else:
+                return None
+            self.injected += 1
+            return fault
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on stalled requests, so writing the late response fails. That's expected.
+        pass
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def use_stub(server, scheduler=None, timeout=None):
+    # Point every knowledge source at the stub and start from a cold, memory-only cache.
+    # Unless told otherwise, send requests as fast as the stub takes them.
+    blackboard.KnowledgeSource.connection_pool = blackboard.ConnectionPool('127.0.0.1', server.port,
+                                                                          size=32, timeout=timeout)
+    blackboard.KnowledgeSource.response_cache = blackboard.ResponseCache(None)
+    blackboard.KnowledgeSource.scheduler = scheduler or blackboard.RequestScheduler()
+
+
+def bench_faults(latency=0.01, similar=20, rates=(0.0, 0.1, 0.3), sessions=8):
+    """ Fill a pool from a stub that fails or stalls some requests, with and without retries """
+    print 'filling a pool of %d songs, %.0f ms per request, stalled requests time out after 250 ms' % (
+        similar, latency * 1000)
+    for rate in rates:
+        for retries in (0, 3):
+            server = StubServer(latency=latency, faults=rate, stalls=rate / 5).start()
+            try:
+                scheduler = blackboard.RequestScheduler(retries=retries, backoff=0.05, seed=0)
+                use_stub(server, scheduler, timeout=0.25)
+                source = blackboard.SimilarTrackSource(blackboard.Blackboard())
+                source.default_limit = similar
+                start = time.time()
+                try:
+                    source.get_recommendations('Artist 0', 'Song of Artist 0', count=similar)
+                    outcome = '%2d songs' % len(source.blackboard.pool)
+                except Exception:
+                    outcome = '  failed'
+                elapsed = time.time() - start
+                source.close()
+                print '  %3.0f%% faults, %d retries: %s in %7.1f ms, %3d requests, %2d faults, %2d retried' % (
+                    rate * 100, retries, outcome, elapsed * 1000, server.requests, server.injected,
+                    scheduler.retried)
+            finally:
+                server.stop()
+    # Sessions seeded with the same artist at once share each request instead of repeating it
+    server = StubServer(latency=latency).start()
+    try:
+        scheduler = blackboard.RequestScheduler()
+        use_stub(server, scheduler)
+        seeders = [blackboard.SimilarTrackSource(blackboard.Blackboard()) for _ in range(sessions)]
+        threads = [threading.Thread(target=seeder.get_recommendations,
+                                    args=('Artist 0', 'Song of Artist 0'), kwargs={'count': 4})
+                   for seeder in seeders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for seeder in seeders:
+            seeder.close()
+        print '  %d sessions seeded at once: %d requests, %d coalesced' % (
+            sessions, server.requests, scheduler.coalesced)
+    finally:
+        server.stop()
+
+
+def bench_fanout(latency=0.05, similar=20, concurrency=(1, 4, 8, 20)):
+    """ Time the artist.getSimilar + artist.getTopTracks fan-out at several concurrency limits """
+    server = StubServer(latency=latency).start()
+    try:
+        print 'fan-out of %d similar artists, %.0f ms per request' % (similar, latency * 1000)
+        for limit in concurrency:
+            use_stub(server)
+            source = blackboard.SimilarTrackSource(blackboard.Blackboard())
+            source.default_limit = similar
+            source.fetch_concurrency = limit
+            start = time.time()
+            top_tracks = source._top_tracks(source._similar_artists('Artist 0'))
+            elapsed = time.time() - start
+            print '  concurrency %3d: %7.1f ms for %d top tracks' % (limit, elapsed * 1000, len(top_tracks))
+    finally:
+        server.stop()
+
+
+def bench_enrichment(latency=0.05, count=4, depths=(1, 4, 8)):
+    """ Time filling the pool with track.getInfo lookups at several prefetch depths """
+    server = StubServer(latency=latency).start()
+    try:
+        print 'enrichment of %d candidates, %.0f ms per request' % (count, latency * 1000)
+        for depth in depths:
+            use_stub(server)
+            source = blackboard.SimilarTrackSource(blackboard.Blackboard())
+            source.prefetch_depth = depth
+            source.data_feed = iter(source._top_tracks(source._similar_artists('Artist 0')))
+            start = time.time()
+            for _ in range(count):
+                source.assure_unique().register()
+            elapsed = time.time() - start
+            print '  prefetch depth %3d: %7.1f ms' % (depth, elapsed * 1000)
+    finally:
+        server.stop()
+
+
+def bench_first(latency=0.05, similar=20, counts=(1, 4, 20)):
+    """ Time until a pool of count songs is registered, fetching all top tracks first or streaming them """
+    server = StubServer(latency=latency).start()
+    try:
+        print 'first recommendations from %d similar artists, %.0f ms per request' % (similar, latency * 1000)
+        for count in counts:
+            for streaming in (False, True):
+                use_stub(server)
+                source = blackboard.SimilarTrackSource(blackboard.Blackboard())
+                source.default_limit = similar
+                requests = []
+                send = source._send
+
+                def counted(params):
+                    requests.append(params['method'])
+                    return send(params)
+                source._send = counted
+                start = time.time()
+                if streaming:
+                    source.get_recommendations('Artist 0', 'Song of Artist 0', count=count)
+                else:
+                    source.data_feed = iter(source._top_tracks(source._similar_artists('Artist 0')))
+                    for _ in range(count):
+                        source.assure_unique().register()
+                elapsed = time.time() - start
+                print '  %2d songs, %-11s %7.1f ms, %3d requests' % (
+                    count, 'streamed:' if streaming else 'all first:', elapsed * 1000, len(requests))
+                source.close()
+    finally:
+        server.stop()
+
+
+def bench_snapshot(rounds=30, pool_size=20):
+    """ Time checkpointing a session after every feedback round, appending or rewriting, and restoring it """
+    server = StubServer().start()
+    directory = tempfile.mkdtemp(prefix='reco-journal-')
+    try:
+        use_stub(server)
+        print 'checkpoints over %d feedback rounds with a pool of %d songs' % (rounds, pool_size)
+        for compact in (False, True):
+            path = os.path.join(directory, 'compacted' if compact else 'appended')
+            journal = blackboard.BlackboardJournal(path)
+            controller = blackboard.Controller()
+            controller.pool_size = pool_size
+            session = blackboard.Session(controller)
+            session.seed('Artist 1', 'Song of Artist 1')
+            elapsed = 0.0
+            written = 0
+            for _ in range(rounds):
+                if session.next() is None:
+                    break
+                session.dislike()
+                controller.blackboard.wait_idle()
+                start = time.time()
+                if compact:
+                    journal.compact(controller, session.current)
+                    written += os.path.getsize(path)
+                else:
+                    written += journal.checkpoint(controller, session.current)
+                elapsed += time.time() - start
+            session.close()
+            start = time.time()
+            restored, current, journal = blackboard.BlackboardJournal.restore(path)
+            restoring = time.time() - start
+            restored.close()
+            print '  %-10s %s and %6d bytes a round, %7d bytes on disk, restored in %s' % (
+                'rewritten:' if compact else 'appended:', _format_ms(elapsed / rounds), written // rounds,
+                os.path.getsize(path), _format_ms(restoring))
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def bench_sharded(seeds=48, rounds=3, processes=(1, 2, 4)):
+    """ Time a batch of seeds from a warm disk cache, serially and sharded across processes """
+    server = StubServer().start()
+    directory = tempfile.mkdtemp(prefix='reco-sharded-')
+    try:
+        use_stub(server)
+        blackboard.KnowledgeSource.response_cache = blackboard.ResponseCache(os.path.join(directory, 'cache'))
+        requests = [json.dumps({'artist': 'Artist %d' % (number * 7), 'track': 'Song of Artist %d' % (number * 7),
+                                'feedback': ['no'] * rounds})
+                    for number in range(seeds)]
+        print 'batch of %d seeds, %d rounds each, from a warm disk cache on %d cores' % (
+            seeds, rounds, blackboard.multiprocessing.cpu_count())
+        # The first run warms the cache that the timed runs share
+        with open(os.devnull, 'w') as output:
+            blackboard.run_batch(requests, output)
+            start = time.time()
+            blackboard.run_batch(requests, output)
+            serial = time.time() - start
+            print '  serial:        %s, %6.2f seeds/s' % (_format_ms(serial), seeds / serial)
+            for count in processes:
+                start = time.time()
+                blackboard.run_sharded_batch(requests, output, os.path.join(directory, 'work'), count,
+                                             shard_size=max(1, seeds // (count * 4)))
+                elapsed = time.time() - start
+                print '  %2d processes:  %s, %6.2f seeds/s, %.2fx serial' % (
+                    count, _format_ms(elapsed), seeds / elapsed, serial / elapsed)
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def synthetic_pool(size, seed=0):
+    """ A blackboard with a seed song and a pool of size songs, built without any requests """
+    board = blackboard.Blackboard()
+    source = blackboard.InfoSource(board)
+    catalog = StubCatalog(artists=size + 1, seed=seed)
+    for number in range(size + 1):
+        artist = catalog.artist(number)
+        info = catalog.respond({'method': 'track.getInfo', 'artist': artist, 'track': catalog.track(artist)})
+        recommendation = blackboard.Recommendation(source, **info['track'])
+        if number == 0:
+            board.solving = blackboard.Assertion(recommendation, source, 'Initial song')
+            board.solving.register()
+        else:
+            recommendation.register()
+    return board
+
+
+def bench_scoring(sizes=(100, 1000, 10000, 50000), rounds=20):
+    """ Time PlaycountSource.choose on a new pool, after a like and after a dislike """
+    print 'PlaycountSource.choose, %s' % ('with NumPy' if blackboard._numpy() else 'without NumPy')
+    for size in sizes:
+        board = synthetic_pool(size)
+        source = blackboard.PlaycountSource(board)
+        start = time.time()
+        source.choose()
+        full = time.time() - start
+        # A like makes the liked song the one to solve for
+        liked = blackboard.Assertion(source.choose()['reco'], board.solving.knowledge_source, 'Liked by user')
+        liked.register()
+        board.solving = liked
+        start = time.time()
+        source.choose()
+        like = time.time() - start
+        # A dislike resigns one song and the refill registers another
+        spare = blackboard.Recommendation(board.solving.knowledge_source, name='Spare', artist={'name': 'Spare'},
+                                          playcount='12345')
+        start = time.time()
+        for _ in range(rounds):
+            song = source.choose()['reco']
+            song.resign()
+            spare.register()
+            spare = song
+        incremental = (time.time() - start) / rounds
+        print '  pool %6d: first ranking %s, like %s, dislike %s' % (size, _format_ms(full), _format_ms(like),
+                                                                     _format_ms(incremental))
+
+
+class LegacyRecommendation(object):
+    """ A recommendation as it was stored before it had slots: the whole payload in __dict__ """
+    def __init__(self, knowledge_source, **json_data):
+        self.blackboard = knowledge_source.blackboard
+        self.knowledge_source = knowledge_source
+        self.__dict__.update(json_data)
+        self.id = "%s - %s" % (self.artist['name'], self.name)
+        self._dependents = [knowledge_source]
+
+
+class LegacyAssumption(object):
+    def __init__(self, recommendation, knowledge_source, reason):
+        self.blackboard = knowledge_source.blackboard
+        self.recommendation = recommendation
+        self.knowledge_source = knowledge_source
+        self.reason = reason
+        self.score = None
+
+
+def deep_size(obj, seen=None):
+    """ Bytes held by obj and everything it references, not counting the blackboard or sources """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, (blackboard.Blackboard, blackboard.KnowledgeSource, type)):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for klass in type(obj).__mro__:
+        for name in getattr(klass, '__slots__', ()):
+            if hasattr(obj, name) and name != '__weakref__':
+                size += deep_size(getattr(obj, name), seen)
+    return size
+
+
+def bench_memory(size=10000):
+    """ Compare the memory held by a pool and its assumptions before and after slots """
+    board = blackboard.Blackboard()
+    source = blackboard.SimilarTrackSource(board)
+    catalog = StubCatalog(artists=size)
+    # Round trip through json so that strings are unicode, as they are from the API
+    payloads = [json.loads(json.dumps(catalog.respond({'method': 'track.getInfo',
+                                                        'artist': catalog.artist(number),
+                                                        'track': catalog.track(catalog.artist(number))})))
+                for number in range(size)]
+    print 'memory held by %d recommendations and an assumption on each' % size
+    for label, recommendation_class, assumption_class in (
+            ('dict-based', LegacyRecommendation, LegacyAssumption),
+            ('slotted', blackboard.Recommendation, blackboard.Assumption)):
+        gc.collect()
+        start = time.time()
+        recommendations = []
+        for payload in payloads:
+            recommendation = recommendation_class(source, **payload['track'])
+            if recommendation_class is blackboard.Recommendation:
+                recommendation.add_dependent(source)
+            recommendations.append((recommendation, assumption_class(recommendation, source, 'Try more plays')))
+        elapsed = time.time() - start
+        seen = set([id(payload) for payload in payloads])
+        held = sum(deep_size(pair, seen) for pair in recommendations)
+        print '  %-10s: %8.1f KB, %6d bytes per song, built in %6.1f ms' % (
+            label, held / 1024.0, held / size, elapsed * 1000)
+
+
+class StageTimer(object):
+    """ Wraps methods of the knowledge sources to add up the time spent in each stage """
+    def __init__(self):
+        self.totals = {}
+
+    def wrap(self, stage, instance, name):
+        method = getattr(instance, name)
+
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.totals[stage] = self.totals.get(stage, 0.0) + time.time() - start
+        setattr(instance, name, timed)
+
+
+def record_fixtures(path, seeds, rounds, similar):
+    """ Record what a run of the recommendation loop asks the stub server for """
+    server = StubServer().start()
+    try:
+        use_stub(server)
+        blackboard.KnowledgeSource.transport = blackboard.FixtureRecorder(path)
+        run_rounds(seeds, rounds, similar)
+    finally:
+        blackboard.KnowledgeSource.transport = None
+        server.stop()
+
+
+def run_rounds(seeds, rounds, similar, timer=None):
+    """ Seed a controller, then dislike its recommendations for a number of rounds """
+    completed = 0
+    for seed in seeds:
+        controller = blackboard.Controller()
+        controller.source_similartracks.default_limit = similar
+        controller.pool_size = similar
+        if timer is not None:
+            timer.wrap('info', controller.source_info, 'get_info')
+            timer.wrap('similar', controller.source_similartracks, '_similar_artists')
+            timer.wrap('candidates', controller.source_similartracks, 'assure_unique')
+            timer.wrap('tagging', controller.source_tags, '_prefetch_tags')
+            timer.wrap('scoring', controller.source_playcount, 'choose')
+            timer.wrap('scoring', controller.source_tags, 'choose')
+        session = blackboard.Session(controller)
+        session.seed(seed, 'Song of %s' % seed)
+        for _ in range(rounds):
+            if session.next() is None:
+                break
+            session.dislike()
+            completed += 1
+        session.close()
+    return completed
+
+
+def bench_replay(fixtures=None, latency=0.02, jitter=0.01, sizes=(10, 50, 200), seeds=3, rounds=5):
+    """ Replay recorded API responses with injected latency and time each stage of the loop
+
+    Without a fixtures directory, fixtures are first recorded from the stub server.
+    """
+    print 'replayed recommendation loop, %.0f ms + up to %.0f ms per request' % (latency * 1000, jitter * 1000)
+    print '  %5s %9s %9s %11s %9s %9s %10s' % ('pool', 'info', 'similar', 'candidates',
+                                             'tagging', 'scoring', 'rounds/s')
+    seed_artists = ['Artist %d' % (number * 37) for number in range(seeds)]
+    for size in sizes:
+        path = fixtures or tempfile.mkdtemp(prefix='reco-fixtures-')
+        try:
+            if fixtures is None:
+                record_fixtures(path, seed_artists, rounds, size)
+            # Replay from a cold, memory-only cache so that every request pays its latency
+            blackboard.KnowledgeSource.response_cache = blackboard.ResponseCache(None)
+            blackboard.KnowledgeSource.scheduler = blackboard.RequestScheduler()
+            blackboard.KnowledgeSource.transport = blackboard.FixtureReplayer(path, latency, jitter)
+            timer = StageTimer()
+            start = time.time()
+            completed = run_rounds(seed_artists, rounds, size, timer)
+            elapsed = time.time() - start
+        finally:
+            blackboard.KnowledgeSource.transport = None
+            if fixtures is None:
+                shutil.rmtree(path)
+        totals = timer.totals
+        # Tagging happens inside TagSource.choose, so don't count it as scoring too
+        totals['scoring'] = totals.get('scoring', 0.0) - totals.get('tagging', 0.0)
+        # Top tracks now stream into the getInfo lookups, so they're timed together as candidates
+        print '  %5d %s %s %s %s %s %10.2f' % (
+            size, _format_ms(totals.get('info')), _format_ms(totals.get('similar')),
+            _format_ms(totals.get('candidates'), 11),
+            _format_ms(totals.get('tagging')), _format_ms(totals.get('scoring')),
+            completed / elapsed)
+
+
+# Run in a fresh interpreter by bench_startup: argv is the stub's port, the cache
+# directory, 'lazy' or 'eager', 'warm' or 'cold', and how long the user takes to type
+STARTUP_SCRIPT = """
+import sys
+import time
+import blackboard
+port, cache, mode, warm, think = sys.argv[1:]
+blackboard.KnowledgeSource.connection_pool = blackboard.ConnectionPool('127.0.0.1', int(port))
+blackboard.KnowledgeSource.response_cache = blackboard.ResponseCache(cache)
+blackboard.KnowledgeSource.scheduler = blackboard.RequestScheduler()
+blackboard.Controller.lazy = mode == 'lazy'
+if warm == 'warm':
+    blackboard.warm_up()
+controller = blackboard.Controller()
+print 'prompt'
+sys.stdout.flush()
+time.sleep(float(think))
+start = time.time()
+controller.source_info.get_info('Artist 1', 'Song of Artist 1')
+controller.source_similartracks.get_recommendations(artist='Artist 1', track='Song of Artist 1',
+                                                    count=controller.pool_size)
+controller.recommend()
+print 'recommendation %f' % (time.time() - start)
+controller.close()
+"""
+
+
+def _start_once(port, cache, mode, warm, think):
+    start = time.time()
+    child = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT, str(port), cache, mode, warm, str(think)],
+                             cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE)
+    prompt = recommendation = None
+    for line in iter(child.stdout.readline, ''):
+        if line.startswith('prompt'):
+            prompt = time.time() - start
+        elif line.startswith('recommendation'):
+            recommendation = float(line.split()[1])
+    child.wait()
+    return prompt, recommendation
+
+
+def bench_startup(latency=0.05, think=0.5, repeat=3):
+    """ Time a fresh process to its first prompt, and from the user's answer to the first recommendation """
+    server = StubServer(latency=latency).start()
+    primed = tempfile.mkdtemp(prefix='reco-cache-')
+    try:
+        print 'startup, %.0f ms per request, %.0f ms to answer the prompt, best of %d' % (
+            latency * 1000, think * 1000, repeat)
+        _start_once(server.port, primed, 'eager', 'cold', 0)
+        for mode, warm, cached, label in (('eager', 'cold', False, 'eager, empty cache'),
+                                          ('lazy', 'warm', False, 'lazy, empty cache'),
+                                          ('eager', 'cold', True, 'eager, disk cache'),
+                                          ('lazy', 'warm', True, 'lazy, warmed disk cache')):
+            results = []
+            for _ in range(repeat):
+                cache = primed if cached else tempfile.mkdtemp(prefix='reco-cache-')
+                try:
+                    results.append(_start_once(server.port, cache, mode, warm, think))
+                finally:
+                    if not cached:
+                        shutil.rmtree(cache)
+            print '  %-24s first prompt %s, first recommendation %s' % (
+                label + ':', _format_ms(min(prompt for prompt, _ in results)),
+                _format_ms(min(recommendation for _, recommendation in results)))
+    finally:
+        server.stop()
+        shutil.rmtree(primed)
+
+
+def _format_ms(seconds, width=9):
+    if seconds is None:
+        return '%*s' % (width, 'skipped')
+    return '%*.1f ms' % (width - 3, seconds * 1000)
+
+
+BENCHMARKS = {'enrichment': bench_enrichment,
+              'fanout': bench_fanout,
+              'faults': bench_faults,
+              'first': bench_first,
+              'memory': bench_memory,
+              'replay': bench_replay,
+              'scoring': bench_scoring,
+              'sharded': bench_sharded,
+              'snapshot': bench_snapshot,
+              'startup': bench_startup}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        if name.startswith('replay='):
+            # Replay a directory of recorded fixtures rather than synthetic ones
+            bench_replay(fixtures=os.path.abspath(name.split('=', 1)[1]))
+        else:
+            BENCHMARKS[name]()
@@ -1,12 +1,66 @@
 #!/usr/bin/env python
+import argparse
+import BaseHTTPServer
+import bisect
+import collections
+import functools
+import hashlib
 import httplib
+import itertools
 import json
+import math
+import mmap
+import multiprocessing
+import multiprocessing.pool
+import operator
+import os
+import Queue
+import random
+import signal
+import socket
+import SocketServer
+import struct
 import sys
+import tempfile
+import threading
+import time
 import urllib
+import urlparse
+import uuid
+import zlib
+
+# NumPy is optional and slow to import, so it's only imported once a source needs it
+numpy = None
+_numpy_imported = False
+
+
+def _numpy():
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy as numpy_module
+        except ImportError:
+            numpy_module = None
+        numpy = numpy_module
+        _numpy_imported = True
+    return numpy
+
+
+def _utf8(params):
+    # urllib.urlencode can't cope with non-ascii unicode values
+    return dict((key, value.encode('utf-8') if isinstance(value, unicode) else value)
+                for key, value in params.items())
+
+
+def _unicode(text):
+    # raw_input and files give byte strings. Names are compared and hashed as unicode.
+    return text.decode('utf-8') if isinstance(text, str) else text
 
 
 class BlackboardObject(object):
     """ An object that can be placed on the blackboard """
+    __slots__ = ('blackboard',)
+
     def __init__(self, blackboard, *args, **kwargs):
         super(BlackboardObject, self).__init__(*args, **kwargs)
         self.blackboard = blackboard
@@ -18,39 +72,433 @@ class BlackboardObject(object):
         self.blackboard.remove(self)
 
 
+class Histogram(object):
+    """ Counts observations into buckets with the given upper bounds """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / float(self.count) if self.count else None,
+                'max': self.max,
+                'buckets': dict(zip(bounds, self.counts))}
+
+
+class MetricsRegistry(object):
+    """ In-process counters, gauges and histograms, dumped as text or JSON
+
+    Nothing is recorded until enabled is set. While it is off, instrumented code
+    pays for one attribute check per call.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value, buckets=Histogram.LATENCY_BUCKETS):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def as_dict(self):
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'gauges': dict(self.gauges),
+                    'histograms': dict((name, histogram.as_dict())
+                                       for name, histogram in self.histograms.items())}
+
+    def dump_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def dump_text(self):
+        metrics = self.as_dict()
+        lines = []
+        for name, value in sorted(metrics['counters'].items()):
+            lines.append('%s %s' % (name, value))
+        for name, value in sorted(metrics['gauges'].items()):
+            lines.append('%s %s' % (name, value))
+        for name, histogram in sorted(metrics['histograms'].items()):
+            lines.append('%s count=%d mean=%.6g max=%.6g' % (name, histogram['count'],
+                                                            histogram['mean'], histogram['max']))
+        return '\n'.join(lines)
+
+    def profile(self, instance, name, profiler=None):
+        """ Time every call to a method of one object, e.g. a KnowledgeSource's choose
+
+        With a cProfile.Profile as profiler, the calls are also profiled with it.
+        unprofile() puts the method back.
+        """
+        method = getattr(instance, name)
+        metric = 'profile:%s.%s' % (type(instance).__name__, name)
+
+        @functools.wraps(method)
+        def profiled(*args, **kwargs):
+            start = time.time()
+            try:
+                if profiler is not None:
+                    return profiler.runcall(method, *args, **kwargs)
+                return method(*args, **kwargs)
+            finally:
+                self.observe(metric, time.time() - start)
+        setattr(instance, name, profiled)
+        return profiled
+
+    def unprofile(self, instance, name):
+        if name in getattr(instance, '__dict__', {}):
+            delattr(instance, name)
+
+
+# The registry the knowledge sources report to. Set METRICS.enabled to start recording.
+METRICS = MetricsRegistry()
+
+
+def timed(metric):
+    """ Record how long each call to the decorated method takes, under metric:Class.method """
+    def decorate(method):
+        @functools.wraps(method)
+        def timed_method(self, *args, **kwargs):
+            if not METRICS.enabled:
+                return method(self, *args, **kwargs)
+            start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                METRICS.observe('%s:%s.%s' % (metric, type(self).__name__, method.__name__),
+                                time.time() - start)
+        return timed_method
+    return decorate
+
+
 class DependencyMixin(object):
     """ This mixin can be added to provide pub-sub features to an object """
+    # Classes using the mixin provide a '_dependents' slot. Dependents are kept in a
+    # tuple because most objects have only one or two of them.
+    __slots__ = ()
+    # Sources choose at the same time, so guard the read-modify-write of the tuple
+    _dependents_lock = threading.Lock()
+
     @property
     def dependents(self):
-        default = []
+        default = ()
         return getattr(self, '_dependents', default)
 
     def add_dependent(self, knowledge_source):
-        if not hasattr(self, '_dependents'):
-            self._dependents = []
-        self._dependents.append(knowledge_source)
+        with self._dependents_lock:
+            self._dependents = self.dependents + (knowledge_source,)
 
     def remove_dependent(self, knowledge_source):
-        if self.dependents:
-            self._dependents.remove(knowledge_source)
+        with self._dependents_lock:
+            if self.dependents:
+                dependents = list(self._dependents)
+                dependents.remove(knowledge_source)
+                self._dependents = tuple(dependents)
 
     def notify(self, response):
+        # The dependents hear about it on the blackboard's event bus, off the caller's thread
         if self.dependents:
-            for knowledge_source in self.dependents:
-                knowledge_source.be_notified(self, response)
+            self.blackboard.events.publish('notify', self, response)
+
+
+class IndexedCollection(object):
+    """ An insertion-ordered collection of blackboard objects, indexed by the given key functions """
+    def __init__(self, **key_functions):
+        self._items = collections.OrderedDict()
+        self._key_functions = key_functions
+        self._indexes = dict((name, {}) for name in key_functions)
+        self._lock = threading.RLock()
+
+    def append(self, item):
+        with self._lock:
+            self._items[id(item)] = item
+            for name, key_function in self._key_functions.items():
+                bucket = self._indexes[name].setdefault(key_function(item), collections.OrderedDict())
+                bucket[id(item)] = item
+
+    def remove(self, item):
+        with self._lock:
+            if self._items.pop(id(item), None) is None:
+                raise ValueError("%s is not on the blackboard" % item)
+            for name, key_function in self._key_functions.items():
+                key = key_function(item)
+                bucket = self._indexes[name][key]
+                del bucket[id(item)]
+                if not bucket:
+                    del self._indexes[name][key]
+
+    def find(self, index, key):
+        with self._lock:
+            return self._indexes[index].get(key, {}).values()
+
+    def first(self, index, key):
+        with self._lock:
+            bucket = self._indexes[index].get(key)
+            if bucket:
+                return next(bucket.itervalues())
+            return None
+
+    def has(self, index, key):
+        return key in self._indexes[index]
+
+    def __contains__(self, item):
+        return id(item) in self._items
+
+    def __iter__(self):
+        # Iterate over a copy so that objects may resign while we loop
+        with self._lock:
+            return iter(self._items.values())
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RankedPool(object):
+    """ Songs kept sorted by a value, with ties in the order the songs were added
+
+    values and songs are parallel columns in rank order. Adding or discarding a song is
+    a binary search, so a source can keep its ranking up to date as the pool changes.
+    """
+    def __init__(self):
+        self.values = []
+        self.songs = []
+        self._values = {}
+        self._sequences = {}
+        self._sequence = 0
+
+    def reset(self, values, songs, order=None):
+        # Rank songs, given in pool order, all at once. order may give the indexes of
+        # the songs already sorted by value, with ties in pool order.
+        first = self._sequence
+        self._sequence += len(songs)
+        if order is None:
+            order = sorted(range(len(songs)), key=values.__getitem__)
+        ids = [id(song) for song in songs]
+        self._values = dict(itertools.izip(ids, values))
+        self._sequences = dict(itertools.izip(ids, itertools.count(first)))
+        self.values = [values[index] for index in order]
+        self.songs = [songs[index] for index in order]
+
+    def add(self, value, song):
+        index = bisect.bisect_right(self.values, value)
+        self.values.insert(index, value)
+        self.songs.insert(index, song)
+        self._values[id(song)] = value
+        self._sequences[id(song)] = self._sequence
+        self._sequence += 1
+
+    def discard(self, song):
+        if id(song) not in self._values:
+            return
+        value = self._values.pop(id(song))
+        del self._sequences[id(song)]
+        index = self.songs.index(song, bisect.bisect_left(self.values, value))
+        del self.values[index]
+        del self.songs[index]
+
+    def clear(self):
+        self.reset([], [])
+
+    def bisect(self, value):
+        # The index of the first song whose value is at least value
+        return bisect.bisect_left(self.values, value)
+
+    def first_like(self, index):
+        # The index of the earliest added song with the same value as the one at index
+        return self.bisect(self.values[index])
+
+    def sequence(self, song):
+        # Songs added earlier have lower sequence numbers
+        return self._sequences[id(song)]
+
+    def __contains__(self, song):
+        return id(song) in self._values
+
+    def __len__(self):
+        return len(self.values)
+
+
+class EventBus(object):
+    """ Delivers blackboard events to the callbacks subscribed to them
+
+    Most callbacks run right away on the publishing thread. Callbacks subscribed with
+    threaded=True are queued instead and run one at a time, in the order they were
+    published, on a thread pool of workers threads shared by every bus. So a bus never
+    runs two of its queued callbacks at once, and every recommendation's events arrive
+    in order. At most workers buses deliver at the same time; the others wait their turn.
+    Publishing blocks while capacity callbacks are still waiting. wait_idle() returns
+    once the queue is empty.
+    """
+    workers = 4
+    shared_workers = None
+    _workers_lock = threading.Lock()
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._subscribers = collections.defaultdict(list)
+        self._queue = collections.deque()
+        self._draining = False
+        self._pending = 0
+        self._errors = []
+        self._condition = threading.Condition()
+
+    @classmethod
+    def _worker_pool(cls):
+        with cls._workers_lock:
+            if cls.shared_workers is None:
+                cls.shared_workers = multiprocessing.pool.ThreadPool(cls.workers)
+            return cls.shared_workers
+
+    def subscribe(self, event, callback, threaded=False):
+        """ callback(event, obj, *args) is called for every matching publish() """
+        self._subscribers[event].append((callback, threaded))
+
+    def publish(self, event, obj, *args):
+        for callback, threaded in self._subscribers.get(event, ()):
+            if threaded:
+                self._enqueue(functools.partial(callback, event, obj, *args))
+            else:
+                callback(event, obj, *args)
+
+    def _enqueue(self, task):
+        with self._condition:
+            while self._pending >= self.capacity:
+                self._condition.wait()
+            self._queue.append(task)
+            self._pending += 1
+            start = not self._draining
+            self._draining = True
+        if start:
+            self._worker_pool().apply_async(self._drain)
+
+    def _drain(self):
+        while True:
+            with self._condition:
+                if not self._queue:
+                    self._draining = False
+                    return
+                task = self._queue.popleft()
+            try:
+                task()
+            except Exception:
+                self._errors.append(sys.exc_info())
+            finally:
+                with self._condition:
+                    self._pending -= 1
+                    self._condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """ Wait for every queued callback to finish, then raise the first error one raised """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        if self._errors:
+            error_type, error, traceback = self._errors.pop(0)
+            del self._errors[:]
+            raise error_type, error, traceback
+        return True
+
+    def is_idle(self):
+        return self._pending == 0
+
+
+def _retractable_key(affirmation):
+    return (affirmation.knowledge_source, affirmation.is_retractable())
 
 
 class Blackboard(object):
     """ The blackboard serves as a shared state on the progress toward a solution to the problem """
+    # Affirmations with these reasons keep a song from being recommended again
+    CONSIDERED_REASONS = ('Initial song', 'Disliked by user', 'Liked by user')
+
     def __init__(self):
-        self.pool = []
-        self.affirmations = []
-        self.solving = None
+        self.pool = IndexedCollection(id=operator.attrgetter('id'),
+                                      source=operator.attrgetter('knowledge_source'))
+        self.affirmations = IndexedCollection(id=operator.attrgetter('recommendation.id'),
+                                              source=operator.attrgetter('knowledge_source'),
+                                              reason=operator.attrgetter('reason'),
+                                              retractable=_retractable_key)
+        self.events = EventBus()
+        self.events.subscribe('notify', self._notify_dependents, threaded=True)
+        self._solving = None
+
+    @property
+    def solving(self):
+        return self._solving
+
+    @solving.setter
+    def solving(self, affirmation):
+        self._solving = affirmation
+        self.publish('solving', affirmation)
+
+    def subscribe(self, observer):
+        """ observer.on_blackboard_event(event, obj) is called on 'register' and 'resign' of
+        a Recommendation and on 'solving' when the song being solved for changes """
+        for event in ('register', 'resign', 'solving'):
+            self.events.subscribe(event, observer.on_blackboard_event)
+
+    def publish(self, event, obj, *args):
+        self.events.publish(event, obj, *args)
+
+    def _notify_dependents(self, event, recommendation, response):
+        for knowledge_source in recommendation.dependents:
+            knowledge_source.be_notified(recommendation, response)
+
+    def wait_idle(self, timeout=None):
+        """ Wait until the knowledge sources have finished reacting to feedback """
+        return self.events.wait_idle(timeout)
+
+    def is_considered(self, recommendation_id):
+        if self.pool.has('id', recommendation_id):
+            return True
+        for affirmation in self.affirmations.find('id', recommendation_id):
+            if affirmation.reason in self.CONSIDERED_REASONS:
+                return True
+        return False
+
+    def retractable_assumption(self, knowledge_source):
+        return self.affirmations.first('retractable', (knowledge_source, True))
 
     def empty_pool(self):
         for rec in self.pool:
             rec.resign()
 
+    @timed('call_time')
     def print_board(self):
         print '\n\n\n\n\n\n\n'
         print '- - - - - THE BLACKBOARD - - - - -'
@@ -79,17 +527,52 @@ class Blackboard(object):
 
 class Recommendation(BlackboardObject, DependencyMixin):
     """ This class represents the individual songs """
+    # The fields the knowledge sources use. The rest of the track.getInfo payload is dropped
+    # unless keep_payload is set. A field missing from the payload is left unset, so
+    # getattr(recommendation, field, default) still returns the default.
+    FIELDS = ('url', 'playcount', 'listeners', 'duration', 'tags')
+    __slots__ = ('knowledge_source', 'id', 'name', 'artist_name', 'plays', '_dependents', '_extra') + FIELDS
+    keep_payload = False
+
     def __init__(self, knowledge_source, **json_data):
         super(Recommendation, self).__init__(knowledge_source.blackboard)
         self.knowledge_source = knowledge_source
-        self.__dict__.update(json_data)
-        self.id = "%s - %s" % (self.artist['name'], self.name)
+        self.name = json_data['name']
+        self.artist_name = json_data['artist']['name']
+        self.id = "%s - %s" % (self.artist_name, self.name)
+        for field in self.FIELDS:
+            if field in json_data:
+                setattr(self, field, json_data[field])
+        # The playcount as a number, parsed once for scoring. A song without one has none.
+        try:
+            self.plays = int(json_data.get('playcount', 0))
+        except (TypeError, ValueError):
+            self.plays = 0
+        self._extra = json_data if self.keep_payload else None
+
+    @property
+    def artist(self):
+        return {'name': self.artist_name}
+
+    def set_extra(self, name, value):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[name] = value
+
+    def __getattr__(self, name):
+        # Only reached for unset fields and for extras
+        extra = self._extra if name != '_extra' else None
+        if extra is not None and name in extra:
+            return extra[name]
+        raise AttributeError(name)
 
     def register(self):
         self.blackboard.pool.append(self)
+        self.blackboard.publish('register', self)
 
     def resign(self):
         self.blackboard.pool.remove(self)
+        self.blackboard.publish('resign', self)
 
     def __str__(self):
         tags = getattr(self, 'tags', None)
@@ -102,6 +585,8 @@ class Recommendation(BlackboardObject, DependencyMixin):
 
 class Assumption(BlackboardObject):
     """ This class represents a piece of knowledge accumulated as we look for a solution """
+    __slots__ = ('recommendation', 'knowledge_source', 'reason', 'score')
+
     def __init__(self, recommendation, knowledge_source, reason):
         super(Assumption, self).__init__(knowledge_source.blackboard)
         self.recommendation = recommendation
@@ -121,6 +606,8 @@ class Assumption(BlackboardObject):
 
 class Assertion(Assumption):
     """ An Assumption that represents a permenent state of affairs """
+    __slots__ = ()
+
     def is_retractable(self):
         return False
 
@@ -128,41 +615,723 @@ class Assertion(Assumption):
         raise Exception("Assertions may not be retracted or resigned.")
 
 
+def _write_json(filename, data):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    # Write to a temporary file and rename it so readers never see a partial file
+    handle, temp_name = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'w') as json_file:
+        json.dump(data, json_file)
+    os.rename(temp_name, filename)
+
+
+class ConnectionPool(object):
+    """ A bounded pool of keep-alive HTTP connections shared by the knowledge sources """
+    def __init__(self, host, port=None, size=8, timeout=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        if self.timeout is None:
+            return httplib.HTTPConnection(self.host, self.port)
+        return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _exchange(self, conn, path):
+        conn.request('GET', path)
+        resp = conn.getresponse()
+        # The body must be read in full before the connection can be reused
+        return resp, resp.read()
+
+    def request(self, path):
+        self._slots.acquire()
+        try:
+            try:
+                conn = self._idle.get_nowait()
+                reused = True
+            except Queue.Empty:
+                conn = self._connect()
+                reused = False
+            try:
+                resp, body = self._exchange(conn, path)
+            except socket.timeout:
+                # A slow server isn't a stale connection, so leave retrying to the caller
+                conn.close()
+                raise
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # The server may have dropped an idle connection. Try once more on a fresh one.
+                conn = self._connect()
+                try:
+                    resp, body = self._exchange(conn, path)
+                except Exception:
+                    conn.close()
+                    raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._idle.put(conn)
+            return resp.status, resp.reason, body
+        finally:
+            self._slots.release()
+
+    def warm(self, count=1):
+        # Connect ahead of the first request so that it doesn't wait on the handshake
+        for _ in range(min(count, self.size)):
+            conn = self._connect()
+            try:
+                conn.connect()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                return
+            self._idle.put(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+class APIError(Exception):
+    """ Raised when the API answers with anything but 200 OK """
+    def __init__(self, status, reason):
+        Exception.__init__(self, "An error occurred when communicating \
+with the server: %s %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+
+
+class _Flight(object):
+    """ A request in progress that identical requests wait on instead of repeating """
+    __slots__ = ('done', 'response', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class RequestScheduler(object):
+    """ Paces, retries and coalesces the requests the knowledge sources send to the API
+
+    Requests take a token from a bucket refilled at rate per second, holding at most
+    burst tokens; a rate of None sends them as fast as they come. Connection errors,
+    timeouts, retryable statuses and Last.fm's retryable error codes are retried up to
+    retries times, waiting a random time up to backoff * 2 ** attempt (capped at
+    max_backoff) in between. A request identical to one already in flight waits for
+    that one's response instead of being sent again.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # Last.fm reports these in the body of a response: 8 operation failed, 11 service
+    # offline, 16 temporarily unavailable and 29 rate limit exceeded
+    RETRY_ERRORS = (8, 11, 16, 29)
+
+    def __init__(self, rate=None, burst=1, retries=3, backoff=0.5, max_backoff=8.0, seed=None):
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._flights = {}
+        self.retried = 0
+        self.coalesced = 0
+        self.throttled = 0.0
+
+    def _take_token(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                self.throttled += wait
+            time.sleep(wait)
+
+    def _should_retry(self, response):
+        status, reason, body = response
+        if status in self.RETRY_STATUSES:
+            return True
+        if status != 200 or '"error"' not in body:
+            return False
+        try:
+            return json.loads(body).get('error') in self.RETRY_ERRORS
+        except (ValueError, AttributeError):
+            return False
+
+    def _send_with_retries(self, send):
+        attempt = 0
+        while True:
+            self._take_token()
+            try:
+                response = send()
+            except (httplib.HTTPException, socket.error):
+                if attempt >= self.retries:
+                    raise
+            else:
+                if attempt >= self.retries or not self._should_retry(response):
+                    return response
+            with self._lock:
+                self.retried += 1
+                delay = self._random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+            if METRICS.enabled:
+                METRICS.increment('api_retries')
+            time.sleep(delay)
+            attempt += 1
+
+    def request(self, key, send):
+        """ Return send()'s (status, reason, body), sharing it with identical requests made meanwhile """
+        with self._lock:
+            flight = self._flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leading:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+        try:
+            flight.response = self._send_with_retries(send)
+            return flight.response
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {'retries': self.retried,
+                    'coalesced': self.coalesced,
+                    'throttled': round(self.throttled, 3),
+                    'in_flight': len(self._flights)}
+
+
+class ResponseCache(object):
+    """ An LRU cache of API responses with a TTL, written through to a directory on disk
+
+    The directory holds at most disk_capacity responses. A sweep removes the expired
+    ones, and once there are more than that, the oldest, down to three quarters of it.
+    """
+    IGNORED_PARAMS = ('api_key', 'format')
+
+    def __init__(self, path=None, capacity=1024, ttl=24 * 60 * 60, disk_capacity=None):
+        self.path = path
+        self.capacity = capacity
+        self.ttl = ttl
+        self.disk_capacity = disk_capacity if disk_capacity is not None else 8 * capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # Files written since the last sweep are counted, overwrites included; until
+        # the first sweep the number on disk is unknown
+        self._disk_files = None
+        self._sweeping = False
+
+    @classmethod
+    def make_key(cls, params):
+        canonical = sorted((key, value) for key, value in _utf8(params).items()
+                           if key not in cls.IGNORED_PARAMS)
+        return urllib.urlencode(canonical)
+
+    def _filename(self, key):
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + '.json')
+
+    def _read_disk(self, key):
+        if self.path is None:
+            return None
+        try:
+            with open(self._filename(key)) as entry_file:
+                entry = json.load(entry_file)
+        except (IOError, ValueError):
+            return None
+        if entry.get('key') != key:
+            return None
+        return entry['stored'], entry['value']
+
+    def _write_disk(self, key, stored, value):
+        if self.path is None:
+            return
+        _write_json(self._filename(key), {'key': key, 'stored': stored, 'value': value})
+        with self._lock:
+            if self._disk_files is not None:
+                self._disk_files += 1
+            sweep = not self._sweeping and (self._disk_files is None or
+                                            self._disk_files > self.disk_capacity)
+            if sweep:
+                self._sweeping = True
+        if sweep:
+            try:
+                self.sweep()
+            finally:
+                with self._lock:
+                    self._sweeping = False
+
+    def _remove_disk(self, key):
+        if self.path is None:
+            return
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
+
+    def _expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    # The disk is read and written outside the lock, so that a slow disk only holds up
+    # the request that missed or stored, not every other thread using the cache.
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and not self._expired(entry[0]):
+                # Re-inserting moves the entry to the most recently used end
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[1]
+        if entry is None:
+            entry = self._read_disk(key)
+        if entry is None or self._expired(entry[0]):
+            if entry is not None:
+                self._remove_disk(key)
+            with self._lock:
+                if entry is not None:
+                    self.evictions += 1
+                self.misses += 1
+            return None
+        with self._lock:
+            # A response put meanwhile is newer than the one read from disk
+            entry = self._entries.pop(key, entry)
+            self._entries[key] = entry
+            self._trim()
+            self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        stored = time.time()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (stored, value)
+            self._trim()
+        self._write_disk(key, stored, value)
+
+    def _trim(self):
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+        for key in keys:
+            self._remove_disk(key)
+
+    def sweep(self):
+        """ Remove expired responses from disk, then the oldest beyond the disk capacity
+
+        Returns the files that are left, newest first.
+        """
+        if self.path is None:
+            return []
+        try:
+            names = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                     if name.endswith('.json')]
+        except OSError:
+            return []
+        now = time.time()
+        kept = []
+        removed = []
+        for modified, filename in sorted(((self._modified(name), name) for name in names), reverse=True):
+            # A file is renamed into place when it's stored, so its mtime is when it was stored
+            if self.ttl is None or now - modified <= self.ttl:
+                kept.append(filename)
+            else:
+                removed.append(filename)
+        # Only trim unexpired responses once there are more than the disk holds
+        if len(kept) > self.disk_capacity:
+            keep = self.disk_capacity - self.disk_capacity // 4
+            kept, removed = kept[:keep], removed + kept[keep:]
+        for filename in removed:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_files = len(kept)
+        return kept
+
+    def warm(self):
+        """ Load the most recently stored responses on disk into memory, up to capacity """
+        if self.path is None:
+            return 0
+        newest = self.sweep()[:self.capacity]
+        loaded = 0
+        # Oldest first, so that the newest end up most recently used
+        for filename in reversed(newest):
+            try:
+                with open(filename) as entry_file:
+                    entry = json.load(entry_file)
+            except (IOError, ValueError):
+                continue
+            if self._expired(entry['stored']):
+                continue
+            with self._lock:
+                # Don't replace anything a request has put there meanwhile
+                if entry['key'] not in self._entries:
+                    self._entries[entry['key']] = (entry['stored'], entry['value'])
+                    self._trim()
+                    loaded += 1
+        return loaded
+
+    @staticmethod
+    def _modified(filename):
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries)}
+
+
+class FixtureRecorder(object):
+    """ Passes API requests through to the server and saves each response as a fixture file """
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, params):
+        key = ResponseCache.make_key(params)
+        return key, os.path.join(self.path, hashlib.sha1(key).hexdigest() + '.json')
+
+    def request(self, params, send):
+        status, reason, body = send(params)
+        key, filename = self._filename(params)
+        _write_json(filename, {'key': key, 'status': status, 'reason': reason, 'body': body})
+        return status, reason, body
+
+
+class FixtureReplayer(FixtureRecorder):
+    """ Serves API responses from fixture files, after a repeatable delay
+
+    Each request waits latency seconds plus up to jitter seconds more. The extra
+    delay depends only on seed and the request, so every run waits the same.
+    """
+    def __init__(self, path, latency=0.0, jitter=0.0, seed=0, passthrough=False):
+        super(FixtureReplayer, self).__init__(path)
+        self.latency = latency
+        self.jitter = jitter
+        self.seed = seed
+        self.passthrough = passthrough
+        self.replayed = 0
+
+    def delay(self, key):
+        return self.latency + self.jitter * random.Random('%s:%s' % (self.seed, key)).random()
+
+    def request(self, params, send):
+        key, filename = self._filename(params)
+        try:
+            with open(filename) as fixture_file:
+                fixture = json.load(fixture_file)
+        except IOError:
+            if self.passthrough:
+                return send(params)
+            raise Exception("There is no recorded response for %s" % key)
+        delay = self.delay(key)
+        if delay:
+            time.sleep(delay)
+        self.replayed += 1
+        return fixture['status'], fixture['reason'], fixture['body'].encode('utf-8')
+
+
+class _Ready(object):
+    """ A result that is already at hand, standing in for a pending one """
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class ArtistIndex(object):
+    """ A read-only, memory-mapped graph of similar artists with their top tracks and track info
+
+    The file is a header, a table of (key hash, offset, length) entries sorted by hash,
+    then a zlib-compressed JSON record for each artist and for each track. Lookups are a
+    binary search over the table. build_artist_index() writes the file.
+    """
+    MAGIC = 'RBAI'
+    VERSION = 1
+    HEADER = struct.Struct('>4sII')
+    ENTRY = struct.Struct('>QII')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as index_file:
+            self._map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise Exception("%s is not an artist index this version can read" % path)
+
+    @staticmethod
+    def artist_key(artist):
+        return u'artist:%s' % _unicode(artist).lower()
+
+    @staticmethod
+    def track_key(artist, track):
+        return u'track:%s - %s' % (_unicode(artist).lower(), _unicode(track).lower())
+
+    @staticmethod
+    def key_hash(key):
+        return struct.unpack('>Q', hashlib.sha1(key.encode('utf-8')).digest()[:8])[0]
+
+    @classmethod
+    def write(cls, path, records):
+        """ Write records, a dict of key to JSON-serializable record, as an index file """
+        blobs = sorted((cls.key_hash(key), zlib.compress(json.dumps(dict(record, key=key))))
+                       for key, record in records.items())
+        offset = cls.HEADER.size + cls.ENTRY.size * len(blobs)
+        handle, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(handle, 'wb') as index_file:
+            index_file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(blobs)))
+            for key_hash, blob in blobs:
+                index_file.write(cls.ENTRY.pack(key_hash, offset, len(blob)))
+                offset += len(blob)
+            for key_hash, blob in blobs:
+                index_file.write(blob)
+        os.rename(temp_name, path)
+
+    def _entry(self, position):
+        return self.ENTRY.unpack_from(self._map, self.HEADER.size + position * self.ENTRY.size)
+
+    def _lookup(self, key):
+        key_hash = self.key_hash(key)
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        # Check the key itself in case two keys share a hash
+        while low < self._count:
+            entry_hash, offset, length = self._entry(low)
+            if entry_hash != key_hash:
+                break
+            record = json.loads(zlib.decompress(self._map[offset:offset + length]))
+            if record['key'] == key:
+                return record
+            low += 1
+        return None
+
+    def artist(self, artist):
+        return self._lookup(self.artist_key(artist))
+
+    def similar(self, artist):
+        record = self.artist(artist)
+        if record is None or record.get('similar') is None:
+            return None
+        return record['similar']
+
+    def top_track(self, artist):
+        record = self.artist(artist)
+        if record is None:
+            return None
+        return record.get('toptrack')
+
+    def track_info(self, artist, track):
+        record = self._lookup(self.track_key(artist, track))
+        if record is None:
+            return None
+        return {'track': record['info']}
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._count
+
+
+def warm_up(connections=2):
+    """ Warm the shared response cache and connection pool on a background thread
+
+    Short-lived runs call this at startup so that loading cached responses and connecting
+    to the API overlap with reading the user's first input.
+    """
+    def warm():
+        KnowledgeSource.response_cache.warm()
+        KnowledgeSource.connection_pool.warm(connections)
+    thread = threading.Thread(target=warm, name='warm-up')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
 class KnowledgeSource(object):
     """ A knowledge source acts upon some data to provide a song recommendation """
     API_KEY = 'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+    API_HOST = 'ws.audioscrobbler.com'
+    # Responses to these methods are stable enough to be served from the cache
+    CACHEABLE_METHODS = ('track.getInfo', 'track.getTopTags',
+                         'artist.getSimilar', 'artist.getTopTracks')
+    # Seconds to wait on a connection before the request counts as failed
+    REQUEST_TIMEOUT = 10
+    # Shared by every knowledge source so that keep-alive connections and responses get reused
+    connection_pool = ConnectionPool(API_HOST, timeout=REQUEST_TIMEOUT)
+    response_cache = ResponseCache(os.path.join(os.path.expanduser('~'), '.reco-blackboard', 'cache'))
+    # Last.fm asks for no more than 5 requests a second, averaged over five minutes
+    scheduler = RequestScheduler(rate=5, burst=50)
+    # When set, every source runs its requests on this thread pool instead of its own
+    shared_workers = None
+    # When set, similar artists, top tracks and track info are read from this ArtistIndex
+    # first and only looked up with the API when the index doesn't have them
+    artist_index = None
+    # When set, requests that miss the cache go through transport.request(params, send)
+    # instead of straight to the server, e.g. to record or replay fixtures
+    transport = None
 
     def __init__(self, blackboard):
         self.blackboard = blackboard
         self.thinking_about = None
         self.data_feed = None
         self.default_limit = 20
-        self.params = {'api_key': API_KEY,
+        # How many API requests a source may have in flight at once
+        self.fetch_concurrency = 8
+        # How many songs from the data feed to look up ahead of time
+        self.prefetch_depth = 4
+        # How many more songs the caller wants from the data feed, when it knows. Songs
+        # are only looked up read_ahead beyond that, in case some turn out to be repeats.
+        self.wanted = None
+        self.read_ahead = 1
+        self._prefetched = collections.deque()
+        # 1 while assure_unique() holds a song taken out of the pipeline
+        self._in_hand = 0
+        self._workers = None
+        # The defaults sent with every request. Build each request from a copy with
+        # _request_params so that requests running at the same time don't collide.
+        self.params = {'api_key': self.API_KEY,
                        'autocorrect': 1,
                        'format': 'json'}
 
+    def _request_params(self, **overrides):
+        params = dict(self.params)
+        params.update(overrides)
+        return params
+
+    def _worker_pool(self):
+        if self.shared_workers is not None:
+            return self.shared_workers
+        if self._workers is None:
+            self._workers = multiprocessing.pool.ThreadPool(self.fetch_concurrency)
+        return self._workers
+
+    def close(self):
+        # Stop the source's worker threads
+        if self._workers is not None:
+            self._workers.terminate()
+            self._workers = None
+        self._prefetched.clear()
+
+    def _try_request(self, params):
+        try:
+            return self._make_request(params)
+        except Exception:
+            return None
+
+    def _fetch_all(self, param_list):
+        # Make the requests concurrently. Results keep the order of param_list and
+        # a request that fails yields None rather than failing the whole batch.
+        if len(param_list) <= 1 or self.fetch_concurrency <= 1:
+            return [self._try_request(params) for params in param_list]
+        return self._worker_pool().map(self._try_request, param_list)
+
+    def _indexed_track_info(self, artist, track):
+        if self.artist_index is None:
+            return None
+        return self.artist_index.track_info(artist, track)
+
+    def _look_ahead(self):
+        # How many more songs from the data feed are worth having on their way
+        if self.wanted is None:
+            return self.prefetch_depth - len(self._prefetched)
+        return min(self.prefetch_depth, self.wanted + self.read_ahead - self._in_hand) - len(self._prefetched)
+
+    def _fill_pipeline(self):
+        # Start looking up the full info of the next few unique songs in the background
+        # The data feed is an iterator, so songs are only produced as they're needed
+        in_flight = set(song_id for song_id, song, song_info in self._prefetched)
+        while self._look_ahead() > 0:
+            song = next(self.data_feed, None)
+            if song is None:
+                break
+            song_id = "%s - %s" % (song['artist']['name'], song['name'])
+            if song_id in in_flight or self.blackboard.is_considered(song_id):
+                continue
+            in_flight.add(song_id)
+            indexed_info = self._indexed_track_info(song['artist']['name'], song['name'])
+            if indexed_info is not None:
+                song_info = _Ready(indexed_info)
+            else:
+                params = self._request_params(method='track.getInfo',
+                                              artist=song['artist']['name'],
+                                              track=song['name'])
+                song_info = self._worker_pool().apply_async(self._make_request, (params,))
+            self._prefetched.append((song_id, song, song_info))
+
     def assure_unique(self, preserve=None):
         while True:
-            if len(self.data_feed) == 0:
+            self._fill_pipeline()
+            if len(self._prefetched) == 0:
                 return None
-            # pop a unique recommendation off the data feed
-            song = self.data_feed.pop()
-            self.params['method'] = 'track.getInfo'
-            self.params['artist'] = song['artist']['name']
-            self.params['track'] = song['name']
-            song_info = self._make_request()
-            rec_new = Recommendation(self, **song_info['track'])
+            # take the oldest unique recommendation out of the pipeline and keep it full
+            song_id, song, song_info = self._prefetched.popleft()
+            self._in_hand = 1
+            try:
+                self._fill_pipeline()
+                try:
+                    track_info = song_info.get()['track']
+                except Exception as error:
+                    # Like a similar artist whose top track failed, leave the song out
+                    print >>sys.stderr, "INFO: Couldn't look up %s, skipping it: %s" % (song_id, error)
+                    continue
+            finally:
+                self._in_hand = 0
+            rec_new = Recommendation(self, **track_info)
             if preserve is not None:
-                setattr(rec_new, preserve, song[preserve])
+                rec_new.set_extra(preserve, song[preserve])
             if not rec_new:
                 return None
-            considered_songs = [idea.recommendation.id for
-                    idea in self.blackboard.affirmations if
-                    idea.reason == 'Initial song' or
-                    idea.reason == 'Disliked by user' or
-                    idea.reason == 'Liked by user']
-            considered_songs.extend([pool.id for pool in self.blackboard.pool])
-            if rec_new.id not in considered_songs:
+            # autocorrect may have renamed the song, so check it once more
+            if not self.blackboard.is_considered(rec_new.id):
                 return rec_new
 
     def be_notified(self, recommendation, response):
@@ -182,17 +1351,63 @@ class KnowledgeSource(object):
                    artist=self.blackboard.solving.recommendation.artist['name'],
                    track=self.blackboard.solving.recommendation.name)
 
-    def _make_request(self):
-        # connect to the API and return a result
-        encoded_params = urllib.urlencode(self.params)
-        conn = httplib.HTTPConnection('ws.audioscrobbler.com')
-        conn.request('GET', '/2.0/?'+encoded_params)
-        resp = conn.getresponse()
-        if resp.status == 200:
-            return json.loads(resp.read())
+    def _send(self, params):
+        encoded_params = urllib.urlencode(_utf8(params))
+        return self.connection_pool.request('/2.0/?'+encoded_params)
+
+    def _transmit_once(self, params):
+        if self.transport is not None:
+            return self.transport.request(params, self._send)
+        return self._send(params)
+
+    def _transmit(self, params):
+        return self.scheduler.request(self.response_cache.make_key(params),
+                                      functools.partial(self._transmit_once, params))
+
+    def _transmit_measured(self, params):
+        method = params.get('method')
+        METRICS.increment('api_requests:%s' % method)
+        start = time.time()
+        try:
+            response = self._transmit(params)
+        except Exception:
+            METRICS.increment('api_errors:%s' % method)
+            raise
+        finally:
+            METRICS.observe('api_latency:%s' % method, time.time() - start)
+        if response[0] != 200:
+            METRICS.increment('api_errors:%s' % method)
+        return response
+
+    def _make_request(self, params):
+        # serve the result from the cache, or connect to the API and return a result
+        cacheable = params.get('method') in self.CACHEABLE_METHODS
+        if cacheable:
+            cache_key = self.response_cache.make_key(params)
+            result = self.response_cache.get(cache_key)
+            if result is not None:
+                if METRICS.enabled:
+                    METRICS.increment('cache_hits:%s' % params.get('method'))
+                return result
+        if METRICS.enabled:
+            status, reason, body = self._transmit_measured(params)
+        else:
+            status, reason, body = self._transmit(params)
+        if status == 200:
+            result = json.loads(body)
+            # Last.fm reports some failures in the body of a 200 response. Don't cache those.
+            if cacheable and 'error' not in result:
+                self.response_cache.put(cache_key, result)
+            return result
         else:
-            raise Exception("An error occurred when communicating \
-with the server: %s %s" % (resp.status, resp.reason))
+            raise APIError(status, reason)
+
+    def snapshot_state(self):
+        """ The source's own state as JSON-serializable data, for BlackboardJournal """
+        return {}
+
+    def restore_state(self, state):
+        pass
 
     def __str__(self):
         return self.__class__.__name__
@@ -204,10 +1419,11 @@ class InfoSource(KnowledgeSource):
         song = "%s - %s" % (artist, track)
         if not self.thinking_about == "%s - %s" % (artist, track):
             self.thinking_about = song
-            self.params['method'] = 'track.getInfo'
-            self.params['artist'] = artist
-            self.params['track'] = track
-            self.data_feed = self._make_request()
+            self.data_feed = self._indexed_track_info(artist, track)
+            if self.data_feed is None:
+                self.data_feed = self._make_request(self._request_params(method='track.getInfo',
+                                                                         artist=artist,
+                                                                         track=track))
         info = Recommendation(self, **self.data_feed['track'])
         info.add_dependent(self)
         affirm = Assertion(info, self, 'Initial song')
@@ -219,95 +1435,360 @@ class InfoSource(KnowledgeSource):
         pass
 
 
+class TagIndex(object):
+    """ Interns tags to integer ids and keeps the tags of each song as a bitset """
+    WEIGHTINGS = ('count', 'jaccard', 'tfidf')
+
+    def __init__(self):
+        self._tag_ids = {}
+        self._document_frequency = []
+        self._songs = {}
+
+    def intern(self, tag):
+        tag_id = self._tag_ids.get(tag)
+        if tag_id is None:
+            tag_id = self._tag_ids[tag] = len(self._tag_ids)
+            self._document_frequency.append(0)
+        return tag_id
+
+    def bits(self, tags):
+        bits = 0
+        for tag in tags:
+            bits |= 1 << self.intern(tag)
+        return bits
+
+    def add(self, song_id, tags):
+        if song_id in self._songs:
+            return self._songs[song_id]
+        bits = self._songs[song_id] = self.bits(tags)
+        for tag_id in self._tag_ids_of(bits):
+            self._document_frequency[tag_id] += 1
+        return bits
+
+    def __contains__(self, song_id):
+        return song_id in self._songs
+
+    def _tag_ids_of(self, bits):
+        tag_id = 0
+        while bits:
+            if bits & 1:
+                yield tag_id
+            bits >>= 1
+            tag_id += 1
+
+    def _idf(self, tag_id):
+        return math.log((1.0 + len(self._songs)) / (1.0 + self._document_frequency[tag_id])) + 1.0
+
+    def scores(self, tags, song_ids, weighting='count'):
+        """ Score each song on how well its tags overlap the given tags, from 0 to 100 """
+        query = self.bits(tags)
+        columns = [self._songs[song_id] for song_id in song_ids]
+        overlaps = [bin(query & bits).count('1') for bits in columns]
+        repeats = collections.Counter(self.intern(tag) for tag in tags)
+        if len(repeats) < len(tags):
+            # A tag listed twice counts twice, as it would matching tag by tag
+            overlaps = [sum(repeats[tag_id] for tag_id in self._tag_ids_of(query & bits))
+                        for bits in columns]
+        if weighting == 'count':
+            return [overlap / float(len(tags)) * 100.0 for overlap in overlaps]
+        if weighting == 'jaccard':
+            return [overlap / float(bin(query | bits).count('1')) * 100.0 if overlap else 0.0
+                    for overlap, bits in zip(overlaps, columns)]
+        if weighting == 'tfidf':
+            idf = dict((tag_id, self._idf(tag_id)) for tag_id in self._tag_ids_of(query))
+            total = sum(idf.values())
+            return [sum(idf[tag_id] for tag_id in self._tag_ids_of(query & bits)) / total * 100.0
+                    if overlap else 0.0
+                    for overlap, bits in zip(overlaps, columns)]
+        raise ValueError("Unknown tag weighting %r. Use one of %s." % (weighting, ', '.join(self.WEIGHTINGS)))
+
+
 class TagSource(KnowledgeSource):
     """ Choose the track with the closest number of tags in common with the original song """
-    def tag_song(self, song):
-        self.params['method'] = 'track.getTopTags'
-        self.params['limit'] = 19
-        self.params['artist'] = song.artist['name']
-        self.params['track'] = song.name
-        results = self._make_request()
+    TAG_LIMIT = 19
+
+    def __init__(self, *args, **kwargs):
+        super(TagSource, self).__init__(*args, **kwargs)
+        self.tag_index = TagIndex()
+        # How tag overlap is scored: 'count', 'jaccard' or 'tfidf'
+        self.weighting = 'count'
+        self.ranking = RankedPool()
+        self._ranked_for = None
+        self._unscored = collections.OrderedDict()
+        self.blackboard.subscribe(self)
+
+    def _tag_params(self, song):
+        return self._request_params(method='track.getTopTags',
+                                    limit=self.TAG_LIMIT,
+                                    artist=song.artist['name'],
+                                    track=song.name)
+
+    def _apply_tags(self, song, results):
         # The API will not obey the limit param here. Slice the result list.
         tag_list = results['toptags']['tag']
         if not isinstance(tag_list, list):
             tag_list = [tag_list]
-        top_tags = [tag['name'] for tag in tag_list][:self.params['limit']]
+        top_tags = [tag['name'] for tag in tag_list][:self.TAG_LIMIT]
         setattr(song, 'tags', top_tags)
 
+    def tag_song(self, song):
+        self._apply_tags(song, self._make_request(self._tag_params(song)))
+
+    def _prefetch_tags(self, songs):
+        # Look up the tags of every untagged song at once rather than one per scoring step
+        untagged = [song for song in songs if getattr(song, 'tags', None) is None]
+        results = self._fetch_all([self._tag_params(song) for song in untagged])
+        for song, result in zip(untagged, results):
+            if result is None:
+                # Try once more on its own so that a real failure gets reported
+                self.tag_song(song)
+            else:
+                self._apply_tags(song, result)
+        for song in songs:
+            self.tag_index.add(song.id, song.tags)
+
     def _register_assumption(self, song):
-        for assumption in self.blackboard.affirmations:
-            if assumption.knowledge_source == self and assumption.is_retractable():
-                if assumption.recommendation.id == song['reco'].id:
-                    return
-                else:
-                    assumption.resign()
-                    break
+        assumption = self.blackboard.retractable_assumption(self)
+        if assumption is not None:
+            if song['reco'] is not None and assumption.recommendation.id == song['reco'].id:
+                return
+            assumption.resign()
+        if song['reco'] is None:
+            # No song shares a tag with the one we're solving for
+            return
         assumption = Assumption(song['reco'], self, "Closest match on tags")
         assumption.score = song['score']
         assumption.register()
         song['reco'].add_dependent(self)
 
+    def on_blackboard_event(self, event, obj):
+        # Queue new songs for scoring and drop resigned ones from the ranking
+        if self._ranked_for is None:
+            return
+        if event == 'solving':
+            self._ranked_for = None
+            self.ranking.clear()
+            self._unscored.clear()
+        elif event == 'register':
+            self._unscored[id(obj)] = obj
+        elif event == 'resign':
+            self._unscored.pop(id(obj), None)
+            self.ranking.discard(obj)
+
+    @timed('scoring_time')
     def choose(self):
-        best_tag_count = 0
+        # Only score the songs added since the last call, unless the solving song or the
+        # weighting changed. tf-idf weights shift with every song tagged, so rescore those.
+        ranked_for = (self.blackboard.solving, self.weighting)
+        rescore = self._ranked_for != ranked_for or self.weighting == 'tfidf'
+        songs = list(self.blackboard.pool) if rescore else self._unscored.values()
+        self._prefetch_tags([self.blackboard.solving.recommendation] + songs)
+        tags_to_match = self.blackboard.solving.recommendation.tags
+        scores = self.tag_index.scores(tags_to_match, [song.id for song in songs], self.weighting)
+        if rescore:
+            self.ranking.reset([-score for score in scores], songs)
+        else:
+            for song, score in zip(songs, scores):
+                self.ranking.add(-score, song)
+        self._unscored.clear()
+        self._ranked_for = ranked_for
+        # The ranking keeps the best score first, ties in pool order
+        best_score = 0
         best_tag_match = None
-        tags_to_match = getattr(self.blackboard.solving.recommendation, 'tags', None)
-        if tags_to_match is None:
-            self.tag_song(self.blackboard.solving.recommendation)
-            tags_to_match = self.blackboard.solving.recommendation.tags
-        for song in self.blackboard.pool:
-            song_tags = getattr(song, 'tags', None)
-            if song_tags is None:
-                self.tag_song(song)
-                song_tags = song.tags
-            tag_match_count = 0
-            for tag in tags_to_match:
-                if tag in song_tags:
-                    tag_match_count += 1
-            if tag_match_count > best_tag_count:
-                best_tag_count = tag_match_count
-                best_tag_match = song
-        score = (best_tag_count/float(len(tags_to_match))) * 100.0
-        best_idea = {'score': score, 'reco': best_tag_match}
+        if self.ranking.values and -self.ranking.values[0] > best_score:
+            best_score = -self.ranking.values[0]
+            best_tag_match = self.ranking.songs[0]
+        best_idea = {'score': best_score, 'reco': best_tag_match}
         self._register_assumption(best_idea)
         return best_idea
 
     def be_notified(self, recommendation, response):
-        for assumption in self.blackboard.affirmations:
-            if assumption.knowledge_source == self:
-                assumption.resign()
-                break
+        assumption = self.blackboard.affirmations.first('source', self)
+        if assumption is not None:
+            assumption.resign()
+
+    def snapshot_state(self):
+        return {'weighting': self.weighting}
+
+    def restore_state(self, state):
+        self.weighting = state['weighting']
 
 class SimilarTrackSource(KnowledgeSource):
     """ Put the top track of a number of similar artists into the pool """
+    # How far to follow similar artists: 1 for the artist's own similar artists,
+    # 2 to add the artists similar to those, and so on
+    hops = 1
+
+    def _similar_to(self, artist):
+        if self.artist_index is not None:
+            similar = self.artist_index.similar(artist)
+            if similar is not None:
+                return similar[:self.default_limit]
+        similar_artists_feed = self._make_request(self._request_params(
+            method='artist.getSimilar', limit=self.default_limit, artist=artist))
+        return [a['name'] for a in similar_artists_feed['similarartists']['artist']]
+
+    def _similar_artists(self, artist):
+        # Breadth first, so nearer artists come first and each in similarity order
+        similar_artists = []
+        artist = _unicode(artist)
+        seen = set([artist.lower()])
+        frontier = [artist]
+        for hop in range(self.hops):
+            next_frontier = []
+            for neighbor in frontier:
+                for similar_artist in self._similar_to(neighbor):
+                    similar_artist = _unicode(similar_artist)
+                    if similar_artist.lower() not in seen:
+                        seen.add(similar_artist.lower())
+                        similar_artists.append(similar_artist)
+                        next_frontier.append(similar_artist)
+            frontier = next_frontier
+        return similar_artists
+
+    def _top_track_params(self, similar_artist):
+        return self._request_params(method='artist.getTopTracks', limit=1, artist=similar_artist)
+
+    def _indexed_top_tracks(self, similar_artist):
+        if self.artist_index is None:
+            return None
+        top_track = self.artist_index.top_track(similar_artist)
+        if top_track is None:
+            return None
+        return {'toptracks': {'track': top_track}}
+
+    def _unpack_top_track(self, similar_artist, result):
+        try:
+            return result['toptracks']['track']
+        except (KeyError, TypeError):
+            print >>sys.stderr, "INFO: Could not look up the top tracks for %s. Skipping it." % similar_artist
+            return None
+
+    def _top_tracks(self, similar_artists):
+        # Look up the top track of every similar artist at once, keeping them in similarity order
+        indexed = {}
+        for similar_artist in similar_artists:
+            result = self._indexed_top_tracks(similar_artist)
+            if result is not None:
+                indexed[similar_artist] = result
+        missing = [similar_artist for similar_artist in similar_artists if similar_artist not in indexed]
+        indexed.update(zip(missing, self._fetch_all([self._top_track_params(similar_artist)
+                                                     for similar_artist in missing])))
+        top_tracks = []
+        for similar_artist in similar_artists:
+            top_track = self._unpack_top_track(similar_artist, indexed[similar_artist])
+            if top_track is not None:
+                top_tracks.append(top_track)
+        return top_tracks
+
+    def _stream_top_tracks(self, artist, similar_artists):
+        """ Yield the top track of each similar artist in similarity order as it arrives
+
+        At most fetch_concurrency lookups run ahead of the song being waited on, and no
+        more than the songs still wanted, counting those already in the pipeline. None
+        are started until the pipeline asks for more songs, so filling a small pool only
+        makes about as many requests as it needs.
+        """
+        remaining = iter(similar_artists)
+        pending = collections.deque()
+        found = 0
+        while True:
+            window = self.fetch_concurrency
+            if self.wanted is not None:
+                window = min(window, self.wanted + self.read_ahead - self._in_hand - len(self._prefetched))
+            while len(pending) < max(window, 1):
+                similar_artist = next(remaining, None)
+                if similar_artist is None:
+                    break
+                result = self._indexed_top_tracks(similar_artist)
+                if result is not None:
+                    result = _Ready(result)
+                elif self.fetch_concurrency <= 1:
+                    result = _Ready(self._try_request(self._top_track_params(similar_artist)))
+                else:
+                    result = self._worker_pool().apply_async(self._try_request,
+                                                             (self._top_track_params(similar_artist),))
+                pending.append((similar_artist, result))
+            if not pending:
+                break
+            similar_artist, result = pending.popleft()
+            top_track = self._unpack_top_track(similar_artist, result.get())
+            if top_track is not None:
+                found += 1
+                yield top_track
+        if similar_artists and not found:
+            raise Exception("There was an error looking up top tracks \
+for artists similar to %s" % artist)
+
+    @timed('call_time')
     def get_recommendations(self, artist, track, count=1, **kwargs):
         if not self.thinking_about == artist:
             self.thinking_about = artist
-            self.params['method'] = 'artist.getSimilar'
-            self.params['limit'] = self.default_limit
-            self.params['artist'] = artist
-            similar_artists_feed = self._make_request()
-            similar_artists = [a['name'] for a in
-                    similar_artists_feed['similarartists']['artist']]
-            self.params['method'] = 'artist.getTopTracks'
-            self.params['limit'] = 1
-            top_tracks = []
-            info_source = InfoSource(self.blackboard)
-            for similar_artist in similar_artists:
-                self.params['artist'] = similar_artist
-                results = self._make_request()
+            similar_artists = self._similar_artists(artist)
+            self.data_feed = self._stream_top_tracks(artist, similar_artists)
+            self._prefetched.clear()
+        try:
+            while count > 0:
+                self.wanted = count
+                rec_toptrack = self.assure_unique()
+                if rec_toptrack:
+                    rec_toptrack.register()
+                    rec_toptrack.add_dependent(self)
+                count -= 1
+        finally:
+            self.wanted = None
+
+
+def build_artist_index(seeds, path, depth=1, limit=20):
+    """ Crawl similar artists out from the seed artists and write an ArtistIndex to path
+
+    Similar artists are followed depth hops out from the seeds. Every artist reached
+    gets its top track and that track's info stored, so recommendations for any of
+    them can be made without a request.
+    """
+    crawler = SimilarTrackSource(Blackboard())
+    crawler.default_limit = limit
+    records = {}
+    seeds = [_unicode(artist) for artist in seeds]
+    artists = list(seeds)
+    frontier = list(seeds)
+    seen = set(artist.lower() for artist in seeds)
+    try:
+        for hop in range(depth + 1):
+            if hop < depth:
+                feeds = crawler._fetch_all([crawler._request_params(method='artist.getSimilar',
+                                                                    limit=limit, artist=artist)
+                                            for artist in frontier])
+            else:
+                feeds = [None] * len(frontier)
+            next_frontier = []
+            for artist, feed in zip(frontier, feeds):
+                record = records.setdefault(ArtistIndex.artist_key(artist), {'name': artist})
                 try:
-                    top_tracks.append(results['toptracks']['track'])
-                except KeyError:
-                    raise Exception("There was an error looking up top tracks \
-for artists similar to %s" % artist)
-            top_tracks.reverse()
-            self.data_feed = top_tracks
-        while count > 0:
-            rec_toptrack = self.assure_unique()
-            if rec_toptrack:
-                rec_toptrack.register()
-                rec_toptrack.add_dependent(self)
-            count -= 1
+                    similar = [a['name'] for a in feed['similarartists']['artist']]
+                except (KeyError, TypeError):
+                    continue
+                record['similar'] = similar
+                for similar_artist in similar:
+                    if similar_artist.lower() not in seen:
+                        seen.add(similar_artist.lower())
+                        artists.append(similar_artist)
+                        next_frontier.append(similar_artist)
+            frontier = next_frontier
+        top_tracks = crawler._top_tracks(artists)
+        infos = crawler._fetch_all([crawler._request_params(method='track.getInfo',
+                                                            artist=top_track['artist']['name'],
+                                                            track=top_track['name'])
+                                    for top_track in top_tracks])
+        for top_track, info in zip(top_tracks, infos):
+            artist = top_track['artist']['name']
+            records.setdefault(ArtistIndex.artist_key(artist), {'name': artist})['toptrack'] = top_track
+            if info is not None and 'track' in info:
+                records[ArtistIndex.track_key(artist, top_track['name'])] = {'info': info['track']}
+    finally:
+        crawler.close()
+    ArtistIndex.write(path, records)
+    return len(artists)
 
 
 class PlaycountSource(KnowledgeSource):
@@ -317,67 +1798,108 @@ class PlaycountSource(KnowledgeSource):
         self.strategies = self._init_strategies()
         self.try_this = None
         self.source_quality = None
+        # The pool ranked on playcount, built on the first choose() and kept in step with
+        # the pool from then on
+        self.ranking = RankedPool()
+        self._ranked = False
+        self._base_playcount = None
+        self.blackboard.subscribe(self)
 
     def _init_strategies(self):
         return {'more': ['more plays', 'a lot more plays'],
                 'fewer': ['fewer plays', 'a lot fewer plays']}
 
     def _register_strategy(self, recommendation, score=None):
-        for assumption in self.blackboard.affirmations:
-            if assumption.knowledge_source == self and assumption.is_retractable():
-                if assumption.recommendation.id == recommendation.id:
-                    return None
-                else:
-                    assumption.resign()
-                    break
+        assumption = self.blackboard.retractable_assumption(self)
+        if assumption is not None:
+            if assumption.recommendation.id == recommendation.id:
+                return None
+            assumption.resign()
         assumption = Assumption(recommendation, self, 'Try %s' % self.try_this)
         if score:
             assumption.score = score
         assumption.register()
         recommendation.add_dependent(self)
 
+    def _init_positions(self):
+        return {'closest playcount':{'delta':sys.maxint,'reco':None,'score':0},
+                'a lot more plays':{'delta':-sys.maxint-1,'reco':None,'score':0},
+                'a lot fewer plays':{'delta':sys.maxint,'reco':None,'score':0},
+                'more plays':{'delta':sys.maxint,'reco':None,'score':0},
+                'fewer plays':{'delta':-sys.maxint-1,'reco':None,'score':0}}
+
+    def on_blackboard_event(self, event, obj):
+        # Ranking on playcount rather than on the difference from the song being solved
+        # for keeps the order the same when that song changes
+        if not self._ranked:
+            return
+        if event == 'register':
+            self.ranking.add(obj.plays, obj)
+        elif event == 'resign':
+            self.ranking.discard(obj)
+
+    def _rank_pool(self):
+        # Rank the whole pool on playcount. Only needed the first time.
+        if self._ranked:
+            return
+        songs = list(self.blackboard.pool)
+        numpy = _numpy()
+        if numpy is not None:
+            # A stable sort keeps songs with the same playcount in pool order
+            plays = numpy.fromiter((song.plays for song in songs), numpy.int64, len(songs))
+            order = numpy.argsort(plays, kind='mergesort')
+            self.ranking.reset(plays.tolist(), songs, order.tolist())
+        else:
+            self.ranking.reset([song.plays for song in songs], songs)
+        self._ranked = True
+
+    def _score_positions(self):
+        # Fill every strategy slot from the ranking. Ties go to the song that came first
+        # in the pool, as they did when choose() walked the pool song by song.
+        position = self._init_positions()
+        ranking = self.ranking
+        values, songs = ranking.values, ranking.songs
+        base_playcount = self._base_playcount
+
+        def fill(strategy, index, closeness):
+            delta_playcount = values[index] - base_playcount
+            diff_playcount = abs((float(delta_playcount)/float(base_playcount)) * 100)
+            position[strategy] = {'delta': delta_playcount,
+                                  'reco': songs[index],
+                                  'score': 100 - diff_playcount if closeness else diff_playcount}
+
+        zero = ranking.bisect(base_playcount)
+        candidates = []
+        if zero < len(values):
+            candidates.append(zero)
+        if zero > 0:
+            candidates.append(ranking.first_like(zero - 1))
+        closest = min(candidates, key=lambda index: (abs(values[index] - base_playcount),
+                                                     ranking.sequence(songs[index])))
+        closest_delta = values[closest] - base_playcount
+        fill('closest playcount', closest, True)
+        if values[-1] > base_playcount:
+            fill('a lot more plays', ranking.first_like(len(values) - 1), False)
+        if values[0] < base_playcount:
+            fill('a lot fewer plays', 0, False)
+        # Whatever would have been displaced from closest playcount is the next step up or down
+        above = ranking.bisect(base_playcount + max(closest_delta, 0) + 1)
+        if above < len(values):
+            fill('more plays', above, True)
+        below = ranking.bisect(base_playcount + min(closest_delta, 0)) - 1
+        if below >= 0:
+            fill('fewer plays', ranking.first_like(below), True)
+        return position
+
+    @timed('scoring_time')
     def choose(self, *args, **kwargs):
         # Return None if we've exhausted our options
         if len(self.blackboard.pool) == 0:
             return None
         # Examine the pool and make a suggestion
-        position = {'closest playcount':{'delta':sys.maxint,'reco':None,'score':0},
-                'a lot more plays':{'delta':-sys.maxint-1,'reco':None,'score':0},
-                'a lot fewer plays':{'delta':sys.maxint,'reco':None,'score':0},
-                'more plays':{'delta':sys.maxint,'reco':None,'score':0},
-                'fewer plays':{'delta':-sys.maxint-1,'reco':None,'score':0}}
-        for song in self.blackboard.pool:
-            delta_playcount =  int(getattr(song, 'playcount', 0)) - int(self.blackboard.solving.recommendation.playcount)
-            diff_playcount = abs((float(delta_playcount)/float(self.blackboard.solving.recommendation.playcount)) * 100)
-            if abs(delta_playcount) < abs(position['closest playcount']['delta']):
-                # Are we displacing a current closest?
-                if position['closest playcount']['delta'] > delta_playcount:
-                    position['more plays']['delta'] = position['closest playcount']['delta']
-                    position['more plays']['reco'] = position['closest playcount']['reco']
-                    position['more plays']['score'] = position['closest playcount']['score']
-                elif position['closest playcount']['delta'] < delta_playcount:
-                    position['fewer plays']['delta'] = position['closest playcount']['delta']
-                    position['fewer plays']['reco'] = position['closest playcount']['reco']
-                    position['fewer plays']['score'] = position['closest playcount']['score']
-                position['closest playcount']['delta'] = delta_playcount
-                position['closest playcount']['reco'] = song
-                position['closest playcount']['score'] = 100 - diff_playcount
-            if delta_playcount > 0 and delta_playcount > position['a lot more plays']['delta']:
-                position['a lot more plays']['delta'] = delta_playcount
-                position['a lot more plays']['reco'] = song
-                position['a lot more plays']['score'] = diff_playcount
-            if delta_playcount < 0 and delta_playcount < position['a lot fewer plays']['delta']:
-                position['a lot fewer plays']['delta'] = delta_playcount
-                position['a lot fewer plays']['reco'] = song
-                position['a lot fewer plays']['score'] = diff_playcount
-            if delta_playcount > 0 and delta_playcount < position['more plays']['delta'] and delta_playcount > position['closest playcount']['delta']:
-                position['more plays']['delta'] = delta_playcount
-                position['more plays']['reco'] = song
-                position['more plays']['score'] = 100 - diff_playcount
-            if delta_playcount < 0 and delta_playcount > position['fewer plays']['delta'] and delta_playcount < position['closest playcount']['delta']:
-                position['fewer plays']['delta'] = delta_playcount
-                position['fewer plays']['reco'] = song
-                position['fewer plays']['score'] = 100 - diff_playcount
+        self._rank_pool()
+        self._base_playcount = self.blackboard.solving.recommendation.plays
+        position = self._score_positions()
         # Based on the Assumptions we've made so far, choose with that strategy
         if self.try_this is None:
             self.try_this = 'closest playcount'
@@ -413,12 +1935,9 @@ class PlaycountSource(KnowledgeSource):
             self.source_quality = 'GOOD'
             self.strategies = self._init_strategies()
         else:
-            playcount_assumption = None
-            for assumption in self.blackboard.affirmations:
-                if assumption.knowledge_source == self:
-                    playcount_assumption = assumption
-                    assumption.resign()
-                    break
+            playcount_assumption = self.blackboard.affirmations.first('source', self)
+            if playcount_assumption is not None:
+                playcount_assumption.resign()
             self.try_this = None
             if playcount_assumption is None or playcount_assumption.recommendation.playcount < self.blackboard.solving.recommendation.playcount:
                 if len(self.strategies['more']) > 0:
@@ -427,18 +1946,247 @@ class PlaycountSource(KnowledgeSource):
                 if len(self.strategies['fewer']) > 0:
                     self.try_this = self.strategies['fewer'].pop()
             if self.try_this is None:
-                print "INFO: The Playcount Source has tried all its strategies without success. Applying a penalty to its suggestions."
+                print >>sys.stderr, "INFO: The Playcount Source has tried all its strategies without success. Applying a penalty to its suggestions."
                 self.source_quality = 'POOR'
                 self.strategies = self._init_strategies()
 
+    def snapshot_state(self):
+        return {'strategies': self.strategies,
+                'try_this': self.try_this,
+                'source_quality': self.source_quality}
+
+    def restore_state(self, state):
+        self.strategies = state['strategies']
+        self.try_this = state['try_this']
+        self.source_quality = state['source_quality']
+
+
+# The kinds of knowledge source every Controller puts to work, by name, in the order they're built
+SOURCES = collections.OrderedDict()
+
+
+def register_source(name, source_class):
+    """ Add a kind of knowledge source to the Controllers made from now on
+
+    The Controller builds one per blackboard and hands it out as controller.source(name)
+    and controller.source_<name>. Sources with a choose() method take part in
+    arbitration: choose() returns {'score': ..., 'reco': ...} or None.
+    """
+    SOURCES[name] = source_class
+
+
+register_source('info', InfoSource)
+register_source('similartracks', SimilarTrackSource)
+register_source('playcount', PlaycountSource)
+register_source('tags', TagSource)
+
+
+class Arbiter(object):
+    """ Asks every scoring source for a suggestion at once and settles on one of them
+
+    The policy decides between the suggestions: 'max' takes the highest score, 'weighted'
+    adds up the scores each song gets times the weight of the source suggesting it, and
+    'learned' does the same with weights learned from how often the user liked each
+    source's picks. A source that hasn't answered within budget seconds sits the round
+    out, and sits out the next rounds too until it has finished. If no source suggests
+    anything in time, the round waits for the first one that does rather than come up
+    empty.
+    """
+    POLICIES = ('max', 'weighted', 'learned')
+    shared_workers = None
+    _workers_lock = threading.Lock()
+
+    def __init__(self, sources, policy='max', budget=None, weights=None):
+        if policy not in self.POLICIES:
+            raise Exception("Unknown arbitration policy %s. Use one of: %s" % (policy, ', '.join(self.POLICIES)))
+        if isinstance(sources, collections.Mapping):
+            self.sources = sources
+        else:
+            self.sources = collections.OrderedDict(sources)
+        self.policy = policy
+        self.budget = budget
+        self.weights = dict(weights or {})
+        self.offered = collections.defaultdict(int)
+        self.liked = collections.defaultdict(int)
+        self._running = {}
+        self._chosen = (None, ())
+
+    @classmethod
+    def _worker_pool(cls):
+        with cls._workers_lock:
+            if cls.shared_workers is None:
+                cls.shared_workers = multiprocessing.pool.ThreadPool(8)
+            return cls.shared_workers
+
+    def weight(self, name):
+        if self.policy == 'learned':
+            # The share of its picks the user liked, starting from an even chance
+            return (self.liked[name] + 1.0) / (self.offered[name] + 2.0)
+        return self.weights.get(name, 1.0)
+
+    def collect(self):
+        """ Return the (name, suggestion) of every source that answered in time """
+        deadline = None if self.budget is None else time.time() + self.budget
+        pending = []
+        for name, source in self.sources.items():
+            late = self._running.get(name)
+            if late is not None:
+                if not late.ready():
+                    continue
+                # Its suggestion was for a round that's over
+                del self._running[name]
+            pending.append((name, self._worker_pool().apply_async(source.choose)))
+        suggestions = []
+        for name, result in pending:
+            try:
+                if deadline is None:
+                    suggestion = result.get()
+                else:
+                    suggestion = result.get(max(deadline - time.time(), 0))
+            except multiprocessing.TimeoutError:
+                self._running[name] = result
+                if METRICS.enabled:
+                    METRICS.increment('late_sources:%s' % name)
+                print >>sys.stderr, "INFO: The %s source ran over the %.2f second budget. Leaving it out of this round." % (name, self.budget)
+                continue
+            if suggestion is not None and suggestion['reco'] is not None:
+                suggestions.append((name, suggestion))
+        # A source that answered with nothing doesn't settle the round while others are still at it
+        if not suggestions and self._running:
+            return self._first_answer(set(name for name, result in pending))
+        return suggestions
+
+    def _first_answer(self, asked):
+        # Wait for the first source to suggest something this round. A source still busy
+        # with an earlier round is asked again once it's done.
+        print >>sys.stderr, "INFO: No source made a suggestion within the budget. Waiting for the first one."
+        while self._running:
+            for name, result in self._running.items():
+                result.wait(0.01)
+                if not result.ready():
+                    continue
+                del self._running[name]
+                if name not in asked:
+                    asked.add(name)
+                    self._running[name] = self._worker_pool().apply_async(self.sources[name].choose)
+                    continue
+                suggestion = result.get()
+                if suggestion is not None and suggestion['reco'] is not None:
+                    return [(name, suggestion)]
+        return []
+
+    def decide(self, suggestions):
+        """ Pick a recommendation from the suggestions. Ties go to the source registered first. """
+        if not suggestions:
+            self._chosen = (None, ())
+            return None
+        totals = collections.OrderedDict()
+        for name, suggestion in suggestions:
+            reco = suggestion['reco']
+            if self.policy == 'max':
+                if reco.id not in totals or suggestion['score'] > totals[reco.id][0]:
+                    totals[reco.id] = (suggestion['score'], reco)
+            else:
+                total = totals.get(reco.id, (0, None))[0]
+                totals[reco.id] = (total + self.weight(name) * suggestion['score'], reco)
+        best_score, best = None, None
+        for score, reco in totals.values():
+            if best is None or score > best_score:
+                best_score, best = score, reco
+        self._chosen = (best.id, [name for name, suggestion in suggestions
+                                  if suggestion['reco'].id == best.id])
+        return best
+
+    def choose(self):
+        return self.decide(self.collect())
+
+    def feedback(self, recommendation, liked):
+        # Credit or debit the sources that suggested the last recommendation made
+        chosen_id, names = self._chosen
+        if chosen_id != recommendation.id:
+            return
+        for name in names:
+            self.offered[name] += 1
+            if liked:
+                self.liked[name] += 1
+        self._chosen = (None, ())
+
+    def settle(self):
+        # Let sources that ran over finish before the blackboard changes under them
+        for result in self._running.values():
+            result.wait()
+
+    def snapshot_state(self):
+        return {'offered': dict(self.offered), 'liked': dict(self.liked)}
+
+    def restore_state(self, state):
+        self.offered.update(state['offered'])
+        self.liked.update(state['liked'])
+
+
+class _LazySources(collections.Mapping):
+    """ The named knowledge sources, each built by build(name) when it's first looked up """
+    def __init__(self, names, build):
+        self._names = list(names)
+        self._build = build
+
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        return self._build(name)
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
 
 class Controller(object):
-    def __init__(self):
+    # How many songs to put into the pool for each song we base recommendations on
+    pool_size = 4
+    # How recommend() settles between the sources' suggestions, see Arbiter
+    policy = 'max'
+    # Seconds the scoring sources have to make their suggestions each round
+    round_budget = 5.0
+    # Build each knowledge source on first use rather than up front. Short-lived runs
+    # that never get as far as scoring then never pay for the scoring sources.
+    lazy = False
+
+    def __init__(self, weights=None):
         self.blackboard = Blackboard()
-        self.source_info = InfoSource(self.blackboard)
-        self.source_similartracks = SimilarTrackSource(self.blackboard)
-        self.source_playcount = PlaycountSource(self.blackboard)
-        self.source_tags = TagSource(self.blackboard)
+        # The sources built so far, in the order they were built
+        self.sources = collections.OrderedDict()
+        if not self.lazy:
+            for name in SOURCES:
+                self.source(name)
+        scoring = [name for name, source_class in SOURCES.items()
+                   if callable(getattr(source_class, 'choose', None))]
+        self.arbiter = Arbiter(_LazySources(scoring, self.source),
+                               policy=self.policy, budget=self.round_budget, weights=weights)
+
+    def source(self, name):
+        """ Return the knowledge source registered as name, building it the first time """
+        source = self.sources.get(name)
+        if source is None:
+            source = self.sources[name] = SOURCES[name](self.blackboard)
+            setattr(self, 'source_%s' % name, source)
+        return source
+
+    def __getattr__(self, attribute):
+        # controller.source_<name> builds a source that hasn't been built yet
+        name = attribute[len('source_'):]
+        if attribute.startswith('source_') and name in SOURCES:
+            return self.source(name)
+        raise AttributeError(attribute)
+
+    def close(self):
+        try:
+            self.arbiter.settle()
+            self.blackboard.wait_idle()
+        finally:
+            for source in self.sources.values():
+                source.close()
 
     def run(self):
         print "Ask me for a recommendation based on a track of your choosing:"
@@ -449,7 +2197,7 @@ class Controller(object):
         print '    ~ getting similar artists and songs...'
         self.source_similartracks.get_recommendations(artist=artist,
                                                   track=track,
-                                                  count=4)
+                                                  count=self.pool_size)
         print '    ~ evaluating...'
         while True:
             best_idea = self.recommend()
@@ -470,6 +2218,8 @@ class Controller(object):
                 else:
                     artist = best_idea.artist['name']
                     track = best_idea.name
+                    print 'Working...'
+                    print '    ~ getting similar artists and songs...'
                     self.like(best_idea)
                     print '    ~ evaluating...'
             else:
@@ -478,34 +2228,895 @@ class Controller(object):
                 print "Working..."
 
     def like(self, recommendation):
+        self.arbiter.settle()
+        self.arbiter.feedback(recommendation, True)
         recommendation.notify('yes')
+        # The sources must have moved on to the liked song before the pool is refilled
+        self.blackboard.wait_idle()
         self.blackboard.empty_pool()
-        print 'Working...'
-        print '    ~ getting similar artists and songs...'
         self.source_similartracks.get_recommendations(artist=recommendation.artist['name'],
                                                   track=recommendation.name,
-                                                  count=4)
+                                                  count=self.pool_size)
 
     def dislike(self, recommendation):
+        # The sources refill the pool in the background. recommend() waits for them.
+        self.arbiter.settle()
+        self.arbiter.feedback(recommendation, False)
         recommendation.resign()
         recommendation.notify('no')
 
     def recommend(self):
+        self.blackboard.wait_idle()
+        if METRICS.enabled:
+            METRICS.increment('rounds')
+            METRICS.observe('pool_size', len(self.blackboard.pool), Histogram.SIZE_BUCKETS)
+            METRICS.observe('affirmations', len(self.blackboard.affirmations), Histogram.SIZE_BUCKETS)
+            METRICS.set_gauge('pool_size', len(self.blackboard.pool))
+            METRICS.set_gauge('affirmations', len(self.blackboard.affirmations))
         if len(self.blackboard.pool) == 0:
             return None
-        playcount_suggestion = self.source_playcount.choose()
-        tagmatch_suggestion = self.source_tags.choose()
-        if playcount_suggestion is not None and tagmatch_suggestion is not None:
-            if playcount_suggestion['score'] >= tagmatch_suggestion['score']:
-                return playcount_suggestion['reco']
-            else:
-                return tagmatch_suggestion['reco']
-        elif playcount_suggestion is None:
-            return tagmatch_suggestion['reco']
+        return self.arbiter.choose()
+
+
+class BlackboardJournal(object):
+    """ An append-only snapshot of a Controller's blackboard and knowledge sources
+
+    The file is a header and then frames, each a length, a CRC32 and a zlib-compressed
+    JSON body. Every checkpoint() appends a frame holding only what changed since the
+    last one: new recommendations and affirmations as columns of their fields, what
+    joined and left the pool and the affirmations by row number, changed dependents,
+    the solving affirmation and changed source state. restore() replays the frames and
+    rebuilds the object graph. A frame cut short by a crash is ignored.
+    """
+    MAGIC = 'RBSJ'
+    VERSION = 1
+    HEADER = struct.Struct('>4sI')
+    FRAME = struct.Struct('>Ii')
+    AFFIRMATION_COLUMNS = ('recommendation', 'source', 'reason', 'score', 'assertion')
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        # fsync every frame, so that a checkpoint survives the machine going down too
+        self.sync = sync
+        self._recommendations = _JournalTable()
+        self._affirmations = _JournalTable()
+        self._pool = []
+        self._affirmed = []
+        self._dependents = {}
+        self._solving = None
+        self._current = None
+        self._states = {}
+
+    def _source_names(self, controller):
+        return dict((id(source), name) for name, source in controller.sources.items())
+
+    def _recommendation_row(self, recommendation, names, columns):
+        row = self._recommendations.row(recommendation)
+        if row is None:
+            row = self._recommendations.add(recommendation)
+            columns.setdefault('source', []).append(names[id(recommendation.knowledge_source)])
+            columns.setdefault('name', []).append(recommendation.name)
+            columns.setdefault('artist', []).append(recommendation.artist_name)
+            # A bit for each field that is set, since unset and None read differently
+            present = 0
+            for bit, field in enumerate(Recommendation.FIELDS):
+                value = getattr(recommendation, field, None)
+                if hasattr(recommendation, field):
+                    present |= 1 << bit
+                columns.setdefault(field, []).append(value)
+            columns.setdefault('present', []).append(present)
+            columns.setdefault('extra', []).append(recommendation._extra)
+        return row
+
+    def _affirmation_row(self, affirmation, names, recommendations, columns):
+        row = self._affirmations.row(affirmation)
+        if row is None:
+            recommendation = self._recommendation_row(affirmation.recommendation, names, recommendations)
+            row = self._affirmations.add(affirmation)
+            values = (recommendation, names[id(affirmation.knowledge_source)], affirmation.reason,
+                      affirmation.score, not affirmation.is_retractable())
+            for column, value in zip(self.AFFIRMATION_COLUMNS, values):
+                columns.setdefault(column, []).append(value)
+        return row
+
+    @staticmethod
+    def _changes(before, after):
+        # Collections keep insertion order, so what stayed keeps its place and new rows go last
+        kept = set(before)
+        added = set(after)
+        return [row for row in before if row not in added], [row for row in after if row not in kept]
+
+    def _frame(self, controller, current):
+        names = self._source_names(controller)
+        board = controller.blackboard
+        recommendations = {}
+        affirmations = {}
+        frame = {}
+        pool = [self._recommendation_row(song, names, recommendations) for song in board.pool]
+        affirmed = [self._affirmation_row(affirmation, names, recommendations, affirmations)
+                    for affirmation in board.affirmations]
+        solving = None
+        if board.solving is not None:
+            solving = self._affirmation_row(board.solving, names, recommendations, affirmations)
+        if current is not None and self._recommendations.row(current) is not None:
+            current = self._recommendations.row(current)
         else:
-            return playcount_suggestion['reco']
+            current = None
+        if recommendations:
+            frame['recommendations'] = recommendations
+        if affirmations:
+            frame['affirmations'] = affirmations
+        for key, before, after in (('pool', self._pool, pool), ('affirmed', self._affirmed, affirmed)):
+            removed, added = self._changes(before, after)
+            if removed or added:
+                frame[key] = {'removed': removed, 'added': added}
+        self._pool, self._affirmed = pool, affirmed
+        # Forget what's gone so that its id() can't be mistaken for a new object's
+        live = set(pool)
+        live.update(self._recommendations.row(affirmation.recommendation) for affirmation in board.affirmations)
+        if solving is not None:
+            live.add(self._recommendations.row(board.solving.recommendation))
+        if current is not None:
+            live.add(current)
+        self._recommendations.retain(live)
+        self._affirmations.retain(set(affirmed + ([solving] if solving is not None else [])))
+        dependents = {}
+        for row in live:
+            recommendation = self._recommendations.objects[row]
+            value = [names[id(source)] for source in recommendation.dependents]
+            if self._dependents.get(row) != value:
+                dependents[str(row)] = self._dependents[row] = value
+        for row in self._dependents.keys():
+            if row not in live:
+                del self._dependents[row]
+        if dependents:
+            frame['dependents'] = dependents
+        if solving != self._solving:
+            frame['solving'] = self._solving = solving
+        if current != self._current:
+            frame['current'] = self._current = current
+        states = dict((name, source.snapshot_state()) for name, source in controller.sources.items())
+        states['arbiter'] = controller.arbiter.snapshot_state()
+        changed = dict((name, state) for name, state in states.items() if self._states.get(name) != state)
+        if changed:
+            frame['states'] = changed
+            self._states.update(json.loads(json.dumps(changed)))
+        return frame
+
+    def _append(self, frame):
+        body = zlib.compress(json.dumps(frame, separators=(',', ':')))
+        new = not os.path.exists(self.path)
+        with open(self.path, 'ab') as journal_file:
+            if new:
+                journal_file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+            journal_file.write(self.FRAME.pack(len(body), zlib.crc32(body)))
+            journal_file.write(body)
+            journal_file.flush()
+            if self.sync:
+                os.fsync(journal_file.fileno())
+        return self.FRAME.size + len(body)
+
+    def checkpoint(self, controller, current=None):
+        """ Append what changed since the last checkpoint and return the bytes written """
+        frame = self._frame(controller, current)
+        if not frame:
+            return 0
+        return self._append(frame)
+
+    def compact(self, controller, current=None):
+        """ Rewrite the journal as a single frame holding the whole state """
+        fresh = BlackboardJournal(self.path, self.sync)
+        frame = fresh._frame(controller, current)
+        body = zlib.compress(json.dumps(frame, separators=(',', ':')))
+        handle, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+        with os.fdopen(handle, 'wb') as journal_file:
+            journal_file.write(self.HEADER.pack(self.MAGIC, self.VERSION))
+            journal_file.write(self.FRAME.pack(len(body), zlib.crc32(body)))
+            journal_file.write(body)
+        os.rename(temp_name, self.path)
+        self.__dict__.update(fresh.__dict__)
+
+    @classmethod
+    def frames(cls, path):
+        for frame, end in cls._read_frames(path):
+            yield frame
+
+    @classmethod
+    def _read_frames(cls, path):
+        # Yields each frame with the offset it ends at
+        with open(path, 'rb') as journal_file:
+            magic, version = cls.HEADER.unpack(journal_file.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise Exception("%s is not a blackboard journal this version can read" % path)
+            while True:
+                header = journal_file.read(cls.FRAME.size)
+                if len(header) < cls.FRAME.size:
+                    return
+                length, checksum = cls.FRAME.unpack(header)
+                body = journal_file.read(length)
+                if len(body) < length or zlib.crc32(body) != checksum:
+                    print >>sys.stderr, "INFO: %s ends in an incomplete checkpoint. Ignoring it." % path
+                    return
+                yield json.loads(zlib.decompress(body)), journal_file.tell()
+
+    def _restore_recommendations(self, controller, columns):
+        for index in range(len(columns['name'])):
+            payload = {'name': columns['name'][index], 'artist': {'name': columns['artist'][index]}}
+            for bit, field in enumerate(Recommendation.FIELDS):
+                if columns['present'][index] & (1 << bit):
+                    payload[field] = columns[field][index]
+            recommendation = Recommendation(controller.source(columns['source'][index]), **payload)
+            recommendation._extra = columns['extra'][index]
+            self._recommendations.add(recommendation)
+
+    def _restore_affirmations(self, controller, columns):
+        for index in range(len(columns['recommendation'])):
+            recommendation = self._recommendations.objects[columns['recommendation'][index]]
+            kind = Assertion if columns['assertion'][index] else Assumption
+            affirmation = kind(recommendation, controller.source(columns['source'][index]),
+                               columns['reason'][index])
+            affirmation.score = columns['score'][index]
+            self._affirmations.add(affirmation)
+
+    def _apply(self, controller, frame):
+        board = controller.blackboard
+        if 'recommendations' in frame:
+            self._restore_recommendations(controller, frame['recommendations'])
+        if 'affirmations' in frame:
+            self._restore_affirmations(controller, frame['affirmations'])
+        for key, table, collection, rows in (('pool', self._recommendations, board.pool, self._pool),
+                                             ('affirmed', self._affirmations, board.affirmations, self._affirmed)):
+            if key in frame:
+                removed = set(frame[key]['removed'])
+                for row in frame[key]['removed']:
+                    collection.remove(table.objects[row])
+                for row in frame[key]['added']:
+                    collection.append(table.objects[row])
+                rows[:] = [row for row in rows if row not in removed] + frame[key]['added']
+        for row, names in frame.get('dependents', {}).items():
+            row = int(row)
+            self._recommendations.objects[row]._dependents = tuple(controller.source(name) for name in names)
+            self._dependents[row] = names
+        if 'solving' in frame:
+            self._solving = frame['solving']
+            board.solving = None if self._solving is None else self._affirmations.objects[self._solving]
+        if 'current' in frame:
+            self._current = frame['current']
+        for name, state in frame.get('states', {}).items():
+            if name == 'arbiter':
+                controller.arbiter.restore_state(state)
+            else:
+                controller.source(name).restore_state(state)
+            self._states[name] = state
+
+    @classmethod
+    def restore(cls, path, controller=None, sync=False):
+        """ Rebuild a Controller from the journal at path
+
+        Returns the controller, the recommendation that was current at the last checkpoint
+        and the journal, ready to append further checkpoints.
+        """
+        journal = cls(path, sync)
+        controller = controller if controller is not None else Controller()
+        end = cls.HEADER.size
+        for frame, end in cls._read_frames(path):
+            journal._apply(controller, frame)
+        if os.path.getsize(path) > end:
+            # Cut off the incomplete checkpoint so that new ones follow the last good one
+            with open(path, 'r+b') as journal_file:
+                journal_file.truncate(end)
+        current = None
+        if journal._current is not None:
+            current = journal._recommendations.objects[journal._current]
+        return controller, current, journal
+
+
+class _JournalTable(object):
+    """ Row numbers for the objects a BlackboardJournal has written, by object identity """
+    def __init__(self):
+        self.objects = {}
+        self._rows = {}
+        self._next = 0
+
+    def row(self, obj):
+        return self._rows.get(id(obj))
+
+    def add(self, obj):
+        # Rows are numbered in the order objects are first written, when restoring too
+        row = self._next
+        self._next += 1
+        self.objects[row] = obj
+        self._rows[id(obj)] = row
+        return row
+
+    def retain(self, rows):
+        # Holding on to the objects keeps their id()s from being reused while they have a row
+        for row in self.objects.keys():
+            if row not in rows:
+                del self._rows[id(self.objects.pop(row))]
+
+
+class UnknownRecommendation(ValueError):
+    """ Raised when a session is asked about a recommendation that isn't in its pool """
+
+
+class Session(object):
+    """ Drives a Controller from code, returning plain dicts instead of printing
+
+    With a journal, a BlackboardJournal, the session checkpoints after every call that
+    changes it. Session.restore(path) picks such a session up again.
+    """
+    def __init__(self, controller=None, journal=None):
+        self.controller = controller if controller is not None else Controller()
+        self.journal = journal
+        self.current = None
+
+    @classmethod
+    def restore(cls, path):
+        controller, current, journal = BlackboardJournal.restore(path)
+        session = cls(controller, journal)
+        session.current = current
+        return session
+
+    def checkpoint(self):
+        if self.journal is None:
+            return 0
+        # Let the sources finish reacting to feedback so the checkpoint is consistent
+        self.controller.blackboard.wait_idle()
+        return self.journal.checkpoint(self.controller, self.current)
+
+    @staticmethod
+    def describe(recommendation):
+        return {'id': recommendation.id,
+                'artist': recommendation.artist['name'],
+                'name': recommendation.name,
+                'url': getattr(recommendation, 'url', None),
+                'playcount': getattr(recommendation, 'playcount', None),
+                'listeners': getattr(recommendation, 'listeners', None),
+                'duration': getattr(recommendation, 'duration', None),
+                'tags': getattr(recommendation, 'tags', None)}
+
+    def _find(self, reco):
+        # Accept a Recommendation, a dict from describe() or a recommendation id
+        if reco is None:
+            reco = self.current
+        if isinstance(reco, Recommendation):
+            return reco
+        if isinstance(reco, dict):
+            reco = reco['id']
+        recommendation = self.controller.blackboard.pool.first('id', reco)
+        if recommendation is None:
+            raise UnknownRecommendation("%s is not in the recommendation pool" % reco)
+        return recommendation
+
+    def seed(self, artist, track):
+        info = self.controller.source_info.get_info(artist, track)
+        self.controller.source_similartracks.get_recommendations(artist=artist,
+                                                                 track=track,
+                                                                 count=self.controller.pool_size)
+        self.checkpoint()
+        return self.describe(info)
+
+    def next(self):
+        self.current = self.controller.recommend()
+        self.checkpoint()
+        if self.current is None:
+            return None
+        return self.describe(self.current)
+
+    def like(self, reco=None):
+        recommendation = self._find(reco)
+        self.controller.like(recommendation)
+        self.checkpoint()
+        return self.describe(recommendation)
+
+    def dislike(self, reco=None):
+        recommendation = self._find(reco)
+        self.controller.dislike(recommendation)
+        self.checkpoint()
+        return self.describe(recommendation)
+
+    def close(self):
+        self.controller.close()
+
+
+def batch_session(request):
+    """ Run one seed with its scripted feedback and yield a result for each recommendation """
+    seed = {'artist': request['artist'], 'track': request['track']}
+    feedback = list(request.get('feedback', []))
+    session = Session()
+    try:
+        session.seed(seed['artist'], seed['track'])
+        # Answer each scripted response, then report the recommendation that would come next
+        for round_number in range(len(feedback) + 1):
+            recommendation = session.next()
+            response = feedback[round_number] if round_number < len(feedback) else None
+            yield {'seed': seed,
+                   'round': round_number,
+                   'recommendation': recommendation,
+                   'feedback': response}
+            if recommendation is None or response is None:
+                break
+            if response.lower() == 'yes':
+                session.like()
+            else:
+                session.dislike()
+    except Exception as error:
+        yield {'seed': seed, 'error': str(error)}
+    finally:
+        session.close()
+
+
+def _share_batch_workers():
+    # Batch sessions come and go quickly. Starting and stopping worker threads for each
+    # source of each session would cost more than the session itself.
+    if KnowledgeSource.shared_workers is None:
+        KnowledgeSource.shared_workers = multiprocessing.pool.ThreadPool(8)
+
+
+def run_batch(requests, output):
+    """ Read JSONL seed requests and stream the recommendations out as JSONL """
+    _share_batch_workers()
+    seeds = 0
+    results = 0
+    start = time.time()
+    for line in requests:
+        line = line.strip()
+        if not line:
+            continue
+        for result in batch_session(json.loads(line)):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            results += 1
+        seeds += 1
+    elapsed = time.time() - start
+    print >>sys.stderr, "INFO: %d seeds, %d results in %.1f s (%.2f seeds/s)" % (
+        seeds, results, elapsed, seeds / elapsed if elapsed else 0.0)
+
+
+def _init_shard_worker(settings):
+    # A forked worker inherits the parent's sockets, locks and thread pool objects, but
+    # not the threads. Start it with its own, sharing only the cache on disk.
+    pool = KnowledgeSource.connection_pool
+    KnowledgeSource.connection_pool = ConnectionPool(pool.host, pool.port, size=pool.size, timeout=pool.timeout)
+    cache = KnowledgeSource.response_cache
+    KnowledgeSource.response_cache = ResponseCache(cache.path, cache.capacity, cache.ttl,
+                                                   disk_capacity=cache.disk_capacity)
+    scheduler = KnowledgeSource.scheduler
+    # The workers split the rate limit between them
+    processes = settings['processes']
+    KnowledgeSource.scheduler = RequestScheduler(rate=scheduler.rate and float(scheduler.rate) / processes,
+                                                 burst=max(1, scheduler.burst // processes),
+                                                 retries=scheduler.retries, backoff=scheduler.backoff,
+                                                 max_backoff=scheduler.max_backoff)
+    # Interrupting the job is the parent's business. It terminates the workers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    KnowledgeSource.shared_workers = None
+    _share_batch_workers()
+    EventBus.shared_workers = None
+    EventBus._workers_lock = threading.Lock()
+    Arbiter.shared_workers = None
+    Arbiter._workers_lock = threading.Lock()
+    Controller.lazy = True
+
+
+def _run_shard(task):
+    """ Run one shard's seeds, checkpointing after each one, and return its result file """
+    index, lines, work_dir = task
+    partial = os.path.join(work_dir, 'shard-%05d.partial' % index)
+    progress = os.path.join(work_dir, 'shard-%05d.progress' % index)
+    # Each line of the progress file is where the results of one more finished seed end
+    offsets = []
+    if os.path.exists(progress):
+        with open(progress) as progress_file:
+            offsets = [int(line) for line in progress_file if line.strip()]
+    results = 0
+    with open(partial, 'ab') as partial_file:
+        # Drop the results of a seed that was cut short
+        partial_file.truncate(offsets[-1] if offsets else 0)
+        with open(progress, 'ab') as progress_file:
+            for line in lines[len(offsets):]:
+                for result in batch_session(json.loads(line)):
+                    partial_file.write(json.dumps(result) + '\n')
+                    results += 1
+                partial_file.flush()
+                os.fsync(partial_file.fileno())
+                progress_file.write('%d\n' % partial_file.tell())
+                progress_file.flush()
+    done = os.path.join(work_dir, 'shard-%05d.jsonl' % index)
+    os.rename(partial, done)
+    os.remove(progress)
+    return done, len(lines) - len(offsets), results
+
+
+def _remove_job_files(work_dir):
+    # Only remove what a sharded batch job writes, and the directory if that leaves it empty
+    for name in os.listdir(work_dir):
+        if name == 'job.json' or (name.startswith('shard-') and
+                                  name.endswith(('.jsonl', '.partial', '.progress'))):
+            os.remove(os.path.join(work_dir, name))
+    try:
+        os.rmdir(work_dir)
+    except OSError:
+        pass
+
+
+def run_sharded_batch(requests, output, work_dir, processes=None, shard_size=50):
+    """ Run JSONL seed requests across a pool of processes and stream the results out in order
+
+    Seeds are split into shards of shard_size consecutive seeds. Each worker process
+    checkpoints its shard after every seed in work_dir, so running the same job again
+    with the same work_dir picks up where it stopped. The workers share the response
+    cache through its directory on disk. Results come out in the order of the seeds,
+    just as run_batch writes them. work_dir must be empty, or hold the progress of the
+    same job. Once every result is written, the job's files are removed, and work_dir
+    too if nothing else is left in it.
+    """
+    lines = [line.strip() for line in requests if line.strip()]
+    processes = processes or multiprocessing.cpu_count()
+    job = {'seeds': hashlib.sha1('\n'.join(lines)).hexdigest(), 'shard_size': shard_size}
+    job_file = os.path.join(work_dir, 'job.json')
+    if os.path.exists(job_file):
+        with open(job_file) as existing:
+            if json.load(existing) != job:
+                raise Exception("%s holds the progress of a different batch job. Remove it or use another." % work_dir)
+    elif os.path.isdir(work_dir) and os.listdir(work_dir):
+        # Never adopt, and later clean up, a directory that has other things in it
+        raise Exception("%s isn't empty and holds no batch job. Use an empty or new directory." % work_dir)
+    else:
+        _write_json(job_file, job)
+    shards = [lines[first:first + shard_size] for first in range(0, len(lines), shard_size)]
+    shard_files = [os.path.join(work_dir, 'shard-%05d.jsonl' % index) for index in range(len(shards))]
+    pending = [(index, shard, work_dir) for index, shard in enumerate(shards)
+               if not os.path.exists(shard_files[index])]
+    print >>sys.stderr, "INFO: %d seeds in %d shards, %d of them still to run on %d processes" % (
+        len(lines), len(shards), len(pending), processes)
+    seeds = 0
+    results = 0
+    start = time.time()
+    # Forked workers would write out whatever is still buffered a second time
+    for stream in (output, sys.stdout, sys.stderr):
+        stream.flush()
+    workers = multiprocessing.Pool(processes, _init_shard_worker, ({'processes': processes},))
+    try:
+        finished = workers.imap(_run_shard, pending)
+        to_run = set(index for index, shard, work_dir in pending)
+        for index, shard_file in enumerate(shard_files):
+            if index in to_run:
+                while True:
+                    # Wait in steps, since a wait without a timeout can't be interrupted
+                    try:
+                        done, shard_seeds, shard_results = finished.next(1)
+                        break
+                    except multiprocessing.TimeoutError:
+                        pass
+                seeds += shard_seeds
+                results += shard_results
+            with open(shard_file) as shard_output:
+                for line in shard_output:
+                    output.write(line)
+            output.flush()
+        workers.close()
+    except BaseException:
+        workers.terminate()
+        raise
+    finally:
+        workers.join()
+    _remove_job_files(work_dir)
+    elapsed = time.time() - start
+    print >>sys.stderr, "INFO: %d seeds, %d results in %.1f s (%.2f seeds/s)" % (
+        seeds, results, elapsed, seeds / elapsed if elapsed else 0.0)
+
+
+class ServerBusy(Exception):
+    """ Raised when the server is already hosting as many sessions as it may """
+
+
+class UnknownSession(Exception):
+    """ Raised for a session id the server isn't hosting, or no longer is """
+
+
+class BadRequest(Exception):
+    """ Raised when a client's request can't be understood """
+
+
+class SessionManager(object):
+    """ Hosts many Sessions at once, each with its own Blackboard and knowledge sources
+
+    Sessions nobody has used for max_idle seconds are closed. start_reaper() checks for
+    them in the background; otherwise they are only looked for when a session is created.
+    """
+    def __init__(self, max_sessions=1000, max_idle=30 * 60):
+        self.max_sessions = max_sessions
+        self.max_idle = max_idle
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._stop_reaper = threading.Event()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def reap(self):
+        # Close the sessions nobody has used for max_idle seconds
+        now = time.time()
+        with self._lock:
+            idle = [session_id for session_id, (session, lock, last_used) in self._sessions.items()
+                    if now - last_used[0] > self.max_idle]
+        for session_id in idle:
+            try:
+                self.close(session_id)
+            except UnknownSession:
+                # Closed by its client meanwhile
+                pass
+        return len(idle)
+
+    def start_reaper(self, interval=None):
+        """ Reap idle sessions every interval seconds until stop_reaper() """
+        interval = interval or min(60.0, self.max_idle)
+        self._stop_reaper.clear()
+
+        def reap_until_stopped():
+            while not self._stop_reaper.wait(interval):
+                self.reap()
+        reaper = threading.Thread(target=reap_until_stopped, name='session-reaper')
+        reaper.daemon = True
+        reaper.start()
+        return reaper
+
+    def stop_reaper(self):
+        self._stop_reaper.set()
+
+    def _get(self, session_id):
+        try:
+            return self._sessions[session_id]
+        except KeyError:
+            raise UnknownSession("Unknown session %r" % session_id)
+
+    def create(self):
+        self.reap()
+        with self._lock:
+            if len(self._sessions) >= self.max_sessions:
+                raise ServerBusy("The server is hosting %d sessions already" % len(self._sessions))
+            session_id = uuid.uuid4().hex
+            self._sessions[session_id] = (Session(), threading.Lock(), [time.time()])
+        return session_id
+
+    def run(self, session_id, action, *args):
+        # Calls on one session take turns. Different sessions run side by side.
+        session, lock, last_used = self._get(session_id)
+        with lock:
+            last_used[0] = time.time()
+            return getattr(session, action)(*args)
+
+    def close(self, session_id):
+        with self._lock:
+            session, lock, last_used = self._get(session_id)
+            del self._sessions[session_id]
+        with lock:
+            session.close()
+
+
+class SessionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ A JSON interface to the sessions of a SessionServer
+
+    POST   /sessions               {"artist": ..., "track": ...} starts a session
+    GET    /sessions/<id>/next     makes the next recommendation
+    POST   /sessions/<id>/like     {"id": ...} likes a recommendation, by default the last one
+    POST   /sessions/<id>/dislike  {"id": ...} dislikes a recommendation, by default the last one
+    DELETE /sessions/<id>          ends the session
+    GET    /stats                  reports the sessions, the shared cache and the request scheduler
+    GET    /metrics                reports the metrics registry, when it is enabled
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        payload = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_body(self, *required):
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+        except ValueError as error:
+            raise BadRequest("The request body isn't JSON: %s" % error)
+        if not isinstance(body, dict):
+            raise BadRequest("The request body must be a JSON object")
+        missing = [name for name in required if name not in body]
+        if missing:
+            raise BadRequest("The request body is missing %s" % ', '.join(missing))
+        return body
+
+    def _dispatch(self, verb):
+        sessions = self.server.sessions
+        parts = [part for part in urlparse.urlparse(self.path).path.split('/') if part]
+        try:
+            if verb == 'GET' and parts == ['metrics']:
+                return self._reply(200, METRICS.as_dict())
+            if verb == 'GET' and parts == ['stats']:
+                return self._reply(200, {'sessions': len(sessions),
+                                         'cache': KnowledgeSource.response_cache.stats(),
+                                         'scheduler': KnowledgeSource.scheduler.stats()})
+            if verb == 'POST' and parts == ['sessions']:
+                body = self._read_body('artist', 'track')
+                session_id = sessions.create()
+                try:
+                    seed = sessions.run(session_id, 'seed', body['artist'], body['track'])
+                except Exception:
+                    sessions.close(session_id)
+                    raise
+                return self._reply(201, {'session': session_id, 'seed': seed})
+            if len(parts) == 2 and parts[0] == 'sessions' and verb == 'DELETE':
+                sessions.close(parts[1])
+                return self._reply(200, {'session': parts[1]})
+            if len(parts) == 3 and parts[0] == 'sessions':
+                session_id, action = parts[1], parts[2]
+                if verb == 'GET' and action == 'next':
+                    return self._reply(200, {'recommendation': sessions.run(session_id, 'next')})
+                if verb == 'POST' and action in ('like', 'dislike'):
+                    reco = self._read_body().get('id')
+                    return self._reply(200, {action: sessions.run(session_id, action, reco)})
+            return self._reply(404, {'error': 'No such resource: %s %s' % (verb, self.path)})
+        # Only the request itself is the client's fault. Whatever else goes wrong is ours,
+        # or Last.fm's.
+        except (BadRequest, UnknownRecommendation) as error:
+            return self._reply(400, {'error': str(error)})
+        except UnknownSession as error:
+            return self._reply(404, {'error': str(error)})
+        except ServerBusy as error:
+            return self._reply(503, {'error': str(error)})
+        except (APIError, socket.error) as error:
+            return self._reply(502, {'error': str(error)})
+        except Exception as error:
+            return self._reply(500, {'error': '%s: %s' % (type(error).__name__, error)})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+
+class SessionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A long-running service that hosts many users' sessions in one process
+
+    Each session gets its own Blackboard and knowledge sources. The response
+    cache, the connection pool and the worker threads are shared by all of them.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, max_sessions=1000, max_idle=30 * 60, workers=32):
+        BaseHTTPServer.HTTPServer.__init__(self, address, SessionHandler)
+        self.sessions = SessionManager(max_sessions=max_sessions, max_idle=max_idle)
+        self.sessions.start_reaper()
+        pool = KnowledgeSource.connection_pool
+        if pool.size < workers:
+            KnowledgeSource.connection_pool = ConnectionPool(pool.host, pool.port, size=workers,
+                                                             timeout=pool.timeout)
+            pool.close()
+        KnowledgeSource.shared_workers = multiprocessing.pool.ThreadPool(workers)
+        # Every session's scoring sources choose at once, so don't let them queue behind each other
+        Arbiter.shared_workers = multiprocessing.pool.ThreadPool(workers)
+        # Nor one session's feedback, and the refill that follows it, behind another's.
+        # Queued callbacks fetch through the KnowledgeSource pool, so they get their own.
+        with EventBus._workers_lock:
+            EventBus.workers = workers
+            if EventBus.shared_workers is not None:
+                EventBus.shared_workers.close()
+            EventBus.shared_workers = multiprocessing.pool.ThreadPool(workers)
+
+    def server_close(self):
+        self.sessions.stop_reaper()
+        BaseHTTPServer.HTTPServer.server_close(self)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommend songs using a blackboard of knowledge sources.")
+    parser.add_argument('--batch', metavar='SEEDS',
+                        help='read seed tracks and scripted yes/no feedback from a JSONL file '
+                             '("-" for stdin) instead of prompting')
+    parser.add_argument('--output', metavar='RESULTS', default='-',
+                        help='where --batch writes its JSONL results (default: stdout)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='run --batch seeds across this many processes, 0 for one per core (default: 1)')
+    parser.add_argument('--shard-size', type=int, default=50,
+                        help='how many seeds each process takes at a time (default: 50)')
+    parser.add_argument('--work-dir', metavar='DIR',
+                        help='where a multi-process --batch keeps its progress so it can resume '
+                             '(default: the output file name plus .shards)')
+    parser.add_argument('--serve', metavar='HOST:PORT',
+                        help='host many sessions at once behind a JSON HTTP interface')
+    parser.add_argument('--build-index', metavar='INDEX',
+                        help='crawl similar artists out from the --seeds artists and write an index')
+    parser.add_argument('--seeds', metavar='ARTISTS',
+                        help='a file of seed artists for --build-index, one per line')
+    parser.add_argument('--depth', type=int, default=1,
+                        help='how many hops of similar artists --build-index follows (default: 1)')
+    parser.add_argument('--index', metavar='INDEX',
+                        help='serve similar artists, top tracks and track info from an index first')
+    parser.add_argument('--hops', type=int, default=1,
+                        help='how many hops of similar artists to draw recommendations from (default: 1)')
+    parser.add_argument('--rate', type=float, default=5,
+                        help='most API requests a second, 0 for no limit (default: 5)')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='how often to retry a failed or rate limited API request (default: 3)')
+    parser.add_argument('--policy', choices=Arbiter.POLICIES, default=Controller.policy,
+                        help='how to settle between the sources\' suggestions (default: max)')
+    parser.add_argument('--budget', type=float, default=Controller.round_budget,
+                        help='seconds the sources have to make suggestions each round (default: 5)')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='record metrics and write them as JSON to FILE ("-" for stderr) on exit')
+    args = parser.parse_args(argv)
+    if args.metrics:
+        METRICS.enabled = True
+    try:
+        _run(args)
+    finally:
+        if args.metrics == '-':
+            print >>sys.stderr, METRICS.dump_json()
+        elif args.metrics:
+            with open(args.metrics, 'w') as metrics_file:
+                metrics_file.write(METRICS.dump_json())
+
+
+def _run(args):
+    KnowledgeSource.scheduler = RequestScheduler(rate=args.rate or None, burst=50, retries=args.retries)
+    if args.index:
+        KnowledgeSource.artist_index = ArtistIndex(args.index)
+    SimilarTrackSource.hops = args.hops
+    Controller.policy = args.policy
+    Controller.round_budget = args.budget or None
+    if args.build_index:
+        if not args.seeds:
+            raise SystemExit("--build-index needs a --seeds file")
+        with open(args.seeds) as seeds_file:
+            seeds = [line.strip().decode('utf-8') for line in seeds_file if line.strip()]
+        count = build_artist_index(seeds, args.build_index, depth=args.depth)
+        print >>sys.stderr, "INFO: Indexed %d artists in %s" % (count, args.build_index)
+    elif args.serve:
+        host, _, port = args.serve.rpartition(':')
+        server = SessionServer((host or '127.0.0.1', int(port)))
+        print >>sys.stderr, "INFO: Serving recommendation sessions on %s:%s" % server.server_address
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    elif args.batch:
+        # Short-lived runs only build what they use and warm up while reading input
+        Controller.lazy = True
+        if args.processes == 1:
+            warm_up()
+        requests = sys.stdin if args.batch == '-' else open(args.batch)
+        output = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            if args.processes != 1:
+                work_dir = args.work_dir or (args.output if args.output != '-' else 'batch') + '.shards'
+                run_sharded_batch(requests, output, work_dir, args.processes or None, args.shard_size)
+            else:
+                run_batch(requests, output)
+        finally:
+            if requests is not sys.stdin:
+                requests.close()
+            if output is not sys.stdout:
+                output.close()
+    else:
+        Controller.lazy = True
+        warm_up()
+        service = Controller()
+        service.run()
 
 
 if __name__ == '__main__':
-    service = Controller()
-    service.run()
+    main()
@@ -0,0 +1,583 @@
+#!/usr/bin/env python
+""" Checks for blackboard.py: python -m unittest test_blackboard
+
+The scoring tests compare the knowledge sources against the loops they replaced,
+on randomly made up pools. The journal test runs a session against the stub API
+from benchmarks.py.
+"""
+import StringIO
+import copy
+import hashlib
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import benchmarks
+import blackboard
+
+TAGS = ['tag %d' % number for number in range(12)]
+
+
+def original_playcount_choice(pool, solving, try_this):
+    """ What PlaycountSource.choose picked when it walked the pool song by song """
+    position = {'closest playcount': {'delta': sys.maxint, 'reco': None, 'score': 0},
+                'a lot more plays': {'delta': -sys.maxint - 1, 'reco': None, 'score': 0},
+                'a lot fewer plays': {'delta': sys.maxint, 'reco': None, 'score': 0},
+                'more plays': {'delta': sys.maxint, 'reco': None, 'score': 0},
+                'fewer plays': {'delta': -sys.maxint - 1, 'reco': None, 'score': 0}}
+    base_playcount = int(solving.playcount)
+    for song in pool:
+        delta_playcount = int(getattr(song, 'playcount', 0)) - base_playcount
+        diff_playcount = abs((float(delta_playcount) / float(base_playcount)) * 100)
+        closest = position['closest playcount']
+        if abs(delta_playcount) < abs(closest['delta']):
+            if closest['delta'] > delta_playcount:
+                position['more plays'] = dict(closest)
+            elif closest['delta'] < delta_playcount:
+                position['fewer plays'] = dict(closest)
+            position['closest playcount'] = {'delta': delta_playcount, 'reco': song,
+                                             'score': 100 - diff_playcount}
+        if delta_playcount > 0 and delta_playcount > position['a lot more plays']['delta']:
+            position['a lot more plays'] = {'delta': delta_playcount, 'reco': song, 'score': diff_playcount}
+        if delta_playcount < 0 and delta_playcount < position['a lot fewer plays']['delta']:
+            position['a lot fewer plays'] = {'delta': delta_playcount, 'reco': song, 'score': diff_playcount}
+        if (delta_playcount > 0 and delta_playcount < position['more plays']['delta'] and
+                delta_playcount > position['closest playcount']['delta']):
+            position['more plays'] = {'delta': delta_playcount, 'reco': song, 'score': 100 - diff_playcount}
+        if (delta_playcount < 0 and delta_playcount > position['fewer plays']['delta'] and
+                delta_playcount < position['closest playcount']['delta']):
+            position['fewer plays'] = {'delta': delta_playcount, 'reco': song, 'score': 100 - diff_playcount}
+    try_this = try_this or 'closest playcount'
+    best_idea = position[try_this]
+    if best_idea['reco'] is None:
+        related = {'a lot more plays': 'more plays',
+                   'more plays': 'a lot more plays',
+                   'a lot fewer plays': 'fewer plays',
+                   'fewer plays': 'a lot fewer plays'}[try_this]
+        if position[related]['reco'] is not None:
+            try_this = related
+        else:
+            try_this = 'closest playcount'
+        best_idea = position[try_this]
+    return best_idea['reco'], best_idea['score'], try_this
+
+
+def original_tag_choice(pool, solving):
+    """ What TagSource.choose picked when it counted every song's tags in common """
+    best_tag_count = 0
+    best_tag_match = None
+    for song in pool:
+        tag_match_count = len([tag for tag in solving.tags if tag in song.tags])
+        if tag_match_count > best_tag_count:
+            best_tag_count = tag_match_count
+            best_tag_match = song
+    return best_tag_match, (best_tag_count / float(len(solving.tags))) * 100.0
+
+
+class RandomBoard(object):
+    """ A blackboard filled with made up songs, without any requests """
+    def __init__(self, rand):
+        self.random = rand
+        self.board = blackboard.Blackboard()
+        self.info = blackboard.InfoSource(self.board)
+        self.songs = 0
+        self.solve(self.song())
+
+    def song(self, playcount=True):
+        self.songs += 1
+        fields = {'name': 'Song %d' % self.songs, 'artist': {'name': 'Artist %d' % self.songs}}
+        if playcount:
+            fields['playcount'] = str(self.random.randint(1, 40))
+        song = blackboard.Recommendation(self.info, **fields)
+        song.tags = self.random.sample(TAGS, self.random.randint(1, 7))
+        return song
+
+    def solve(self, song):
+        assertion = blackboard.Assertion(song, self.info, 'Initial song')
+        assertion.register()
+        self.board.solving = assertion
+
+    def add(self):
+        # Now and then a song without a playcount, which counts as none
+        song = self.song(playcount=self.random.random() > 0.1)
+        song.register()
+        return song
+
+    def remove(self):
+        song = self.random.choice(list(self.board.pool))
+        song.resign()
+        return song
+
+
+class ScoringTest(unittest.TestCase):
+    def assertSameChoice(self, expected, actual):
+        self.assertIs(actual[0], expected[0])
+        self.assertAlmostEqual(actual[1], expected[1], places=9)
+        self.assertEqual(actual[2:], expected[2:])
+
+    def check_playcount(self):
+        rand = random.Random(1)
+        strategies = [None, 'more plays', 'a lot more plays', 'fewer plays', 'a lot fewer plays']
+        for trial in range(500):
+            board = RandomBoard(rand)
+            for _ in range(rand.randint(1, 8)):
+                board.add()
+            pool = list(board.board.pool)
+            solving = board.board.solving.recommendation
+            for try_this in strategies:
+                source = blackboard.PlaycountSource(board.board)
+                source.try_this = try_this
+                expected = original_playcount_choice(pool, solving, try_this)
+                best_idea = source.choose()
+                self.assertSameChoice(expected, (best_idea['reco'], best_idea['score'], source.try_this))
+
+    def test_playcount_matches_original_loop(self):
+        self.check_playcount()
+
+    def test_playcount_matches_original_loop_without_numpy(self):
+        imported, module = blackboard._numpy_imported, blackboard.numpy
+        blackboard._numpy_imported, blackboard.numpy = True, None
+        try:
+            self.check_playcount()
+        finally:
+            blackboard._numpy_imported, blackboard.numpy = imported, module
+
+    def test_tags_match_original_loop(self):
+        rand = random.Random(2)
+        for trial in range(500):
+            board = RandomBoard(rand)
+            for _ in range(rand.randint(1, 8)):
+                board.add()
+            source = blackboard.TagSource(board.board)
+            expected = original_tag_choice(list(board.board.pool), board.board.solving.recommendation)
+            best_idea = source.choose()
+            self.assertSameChoice(expected, (best_idea['reco'], best_idea['score']))
+
+    def test_incremental_updates_match_rescoring(self):
+        # Keep two sources scoring one board as songs come and go and the solving song
+        # changes, and compare each round with scoring the pool from scratch
+        rand = random.Random(3)
+        for trial in range(300):
+            board = RandomBoard(rand)
+            for _ in range(rand.randint(1, 6)):
+                board.add()
+            playcount = blackboard.PlaycountSource(board.board)
+            tags = blackboard.TagSource(board.board)
+            for step in range(8):
+                action = rand.random()
+                if action < 0.4 and len(board.board.pool) > 1:
+                    board.remove()
+                elif action < 0.8:
+                    board.add()
+                elif action < 0.9:
+                    board.solve(board.song())
+                pool = list(board.board.pool)
+                solving = board.board.solving.recommendation
+                expected = original_playcount_choice(pool, solving, playcount.try_this)
+                best_idea = playcount.choose()
+                self.assertSameChoice(expected, (best_idea['reco'], best_idea['score'], playcount.try_this))
+                expected = original_tag_choice(pool, solving)
+                best_idea = tags.choose()
+                self.assertSameChoice(expected, (best_idea['reco'], best_idea['score']))
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def files(self):
+        return len([name for name in os.listdir(self.directory) if name.endswith('.json')])
+
+    def test_least_recently_used_is_evicted(self):
+        cache = blackboard.ResponseCache(capacity=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual({'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2}, cache.stats())
+
+    def test_expired_responses_are_misses(self):
+        cache = blackboard.ResponseCache(self.directory, ttl=60)
+        cache.put('a', 1)
+        stored, value = cache._entries['a']
+        cache._entries['a'] = (stored - 61, value)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(0, self.files())
+        self.assertEqual({'hits': 0, 'misses': 1, 'evictions': 1, 'size': 0}, cache.stats())
+
+    def test_responses_survive_a_restart(self):
+        cache = blackboard.ResponseCache(self.directory, capacity=2)
+        for number in range(4):
+            cache.put('key %d' % number, {'value': number})
+        restarted = blackboard.ResponseCache(self.directory, capacity=2)
+        self.assertEqual({'value': 0}, restarted.get('key 0'))
+        self.assertEqual(2, restarted.warm())
+        self.assertEqual({'hits': 1, 'misses': 0, 'evictions': 1, 'size': 2}, restarted.stats())
+
+    def test_disk_is_only_trimmed_when_over_capacity(self):
+        cache = blackboard.ResponseCache(self.directory, disk_capacity=100)
+        for number in range(91):
+            cache.put('key %d' % number, number)
+        self.assertEqual(91, self.files())
+        # A restart sweeps, but keeps every unexpired response while there's room
+        restarted = blackboard.ResponseCache(self.directory, disk_capacity=100)
+        restarted.put('key 91', 91)
+        self.assertEqual(92, self.files())
+        for number in range(92, 101):
+            restarted.put('key %d' % number, number)
+        self.assertEqual(75, self.files())
+        # The newest are the ones kept
+        self.assertEqual(100, blackboard.ResponseCache(self.directory).get('key 100'))
+
+    def test_sweep_removes_expired_files(self):
+        cache = blackboard.ResponseCache(self.directory, ttl=60)
+        cache.put('old', 1)
+        cache.put('new', 2)
+        old = cache._filename('old')
+        os.utime(old, (time.time() - 120, time.time() - 120))
+        self.assertEqual([cache._filename('new')], cache.sweep())
+        self.assertFalse(os.path.exists(old))
+
+
+class SlowSource(object):
+    """ Wraps a knowledge source to take delay seconds over every choice """
+    def __init__(self, source, delay):
+        self.source = source
+        self.delay = delay
+
+    def choose(self):
+        time.sleep(self.delay)
+        return self.source.choose()
+
+
+class ArbiterTest(unittest.TestCase):
+    def test_rounds_wait_when_every_source_is_late(self):
+        board = RandomBoard(random.Random(4))
+        for _ in range(10):
+            board.add()
+        arbiter = blackboard.Arbiter([('playcount', SlowSource(blackboard.PlaycountSource(board.board), 0.2)),
+                                      ('tags', SlowSource(blackboard.TagSource(board.board), 0.3))],
+                                     budget=0.05)
+        # The second and third rounds start while a source is still busy with the last
+        for _ in range(3):
+            self.assertIn(arbiter.choose(), list(board.board.pool))
+        arbiter.settle()
+
+    def test_rounds_wait_when_the_only_answer_in_time_is_empty(self):
+        # As TagSource answers when no song shares a tag with the one being solved for
+        board = RandomBoard(random.Random(6))
+        for _ in range(5):
+            board.add()
+        nothing = SlowSource(None, 0)
+        nothing.choose = lambda: {'reco': None, 'score': 0}
+        arbiter = blackboard.Arbiter([('nothing', nothing),
+                                      ('playcount', SlowSource(blackboard.PlaycountSource(board.board), 0.3))],
+                                     budget=0.05)
+        self.assertIn(arbiter.choose(), list(board.board.pool))
+
+    def test_empty_pool_has_no_recommendation(self):
+        board = RandomBoard(random.Random(5))
+        arbiter = blackboard.Arbiter([('playcount', SlowSource(blackboard.PlaycountSource(board.board), 0.1))],
+                                     budget=0.01)
+        self.assertIsNone(arbiter.choose())
+
+
+class ArtistIndexTest(unittest.TestCase):
+    # Seeds typed at the prompt arrive as UTF-8 byte strings, the index holds unicode
+    BJORK = u'Bj\xf6rk'
+    SIGUR_ROS = u'Sigur R\xf3s'
+    MUM = u'M\xfam'
+    JOGA = u'J\xf3ga'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, 'artists.idx')
+        key = blackboard.ArtistIndex.artist_key
+        info = {'name': self.JOGA, 'artist': {'name': self.BJORK}, 'playcount': '10'}
+        blackboard.ArtistIndex.write(path, {
+            key(self.BJORK): {'name': self.BJORK, 'similar': [self.SIGUR_ROS], 'toptrack': info},
+            key(self.SIGUR_ROS): {'name': self.SIGUR_ROS, 'similar': [self.BJORK.upper(), self.MUM]},
+            blackboard.ArtistIndex.track_key(self.BJORK, self.JOGA): {'info': info}})
+        self.index = blackboard.ArtistIndex(path)
+        self.saved = blackboard.KnowledgeSource.artist_index
+        blackboard.KnowledgeSource.artist_index = self.index
+
+    def tearDown(self):
+        blackboard.KnowledgeSource.artist_index = self.saved
+        self.index.close()
+        shutil.rmtree(self.directory)
+
+    def test_byte_string_names_find_unicode_records(self):
+        for artist in (self.BJORK, self.BJORK.encode('utf-8')):
+            self.assertEqual([self.SIGUR_ROS], self.index.similar(artist))
+            self.assertEqual(self.JOGA, self.index.top_track(artist)['name'])
+            self.assertEqual(self.JOGA, self.index.track_info(artist, self.JOGA.encode('utf-8'))['track']['name'])
+
+    def test_non_ascii_seed(self):
+        board = blackboard.Blackboard()
+        info = blackboard.InfoSource(board).get_info(self.BJORK.encode('utf-8'), self.JOGA.encode('utf-8'))
+        self.assertEqual(self.JOGA, info.name)
+        source = blackboard.SimilarTrackSource(board)
+        source.hops = 2
+        # The seed comes back two hops out in other case, and is left out again
+        self.assertEqual([self.SIGUR_ROS, self.MUM], source._similar_artists(self.BJORK.encode('utf-8')))
+
+
+def session_state(session):
+    board = session.controller.blackboard
+    return {'pool': [song.id for song in board.pool],
+            'affirmations': [(assumption.recommendation.id, assumption.reason, assumption.score,
+                              assumption.is_retractable(), str(assumption.knowledge_source))
+                             for assumption in board.affirmations],
+            'solving': board.solving and (board.solving.recommendation.id, board.solving.reason),
+            'playcount': copy.deepcopy(session.controller.source_playcount.snapshot_state()),
+            'current': session.current and session.current.id,
+            'dependents': sorted((song.id, tuple(map(str, song.dependents))) for song in board.pool)}
+
+
+class StubTestCase(unittest.TestCase):
+    """ Points the knowledge sources at a stub of the API for the length of each test """
+    def setUp(self):
+        self.saved = (blackboard.KnowledgeSource.connection_pool,
+                      blackboard.KnowledgeSource.response_cache,
+                      blackboard.KnowledgeSource.scheduler)
+        self.server = benchmarks.StubServer().start()
+        benchmarks.use_stub(self.server)
+
+    def tearDown(self):
+        self.server.stop()
+        blackboard.KnowledgeSource.connection_pool.close()
+        (blackboard.KnowledgeSource.connection_pool,
+         blackboard.KnowledgeSource.response_cache,
+         blackboard.KnowledgeSource.scheduler) = self.saved
+
+
+class SimilarTrackTest(StubTestCase):
+    def test_failed_track_info_skips_the_song(self):
+        source = blackboard.SimilarTrackSource(blackboard.Blackboard())
+        make_request = source._make_request
+
+        def failing(params):
+            if params['method'] == 'track.getInfo' and params['artist'] == 'Artist 3':
+                raise blackboard.APIError(503, 'Service Unavailable')
+            return make_request(params)
+        source._make_request = failing
+        try:
+            source.get_recommendations('Artist 0', 'Song of Artist 0', count=5)
+        finally:
+            source.close()
+        artists = [song.artist['name'] for song in source.blackboard.pool]
+        self.assertEqual(['Artist 1', 'Artist 2', 'Artist 4', 'Artist 5', 'Artist 6'], artists)
+
+
+    def test_read_ahead_is_bounded_by_songs_wanted(self):
+        source = blackboard.SimilarTrackSource(blackboard.Blackboard())
+        try:
+            source.get_recommendations('Artist 0', 'Song of Artist 0', count=1)
+        finally:
+            source.close()
+        self.assertEqual(1, len(source.blackboard.pool))
+        # Similar artists, then a top track and its info for the song and one spare
+        self.assertEqual(5, self.server.requests)
+
+
+class SchedulerTest(StubTestCase):
+    """ The request scheduler against a stub that fails or stalls the requests it's told to """
+    PARAMS = {'method': 'track.getInfo', 'artist': 'Artist 1', 'track': 'Song of Artist 1'}
+
+    def source(self, scheduler, timeout=None):
+        benchmarks.use_stub(self.server, scheduler, timeout=timeout)
+        return blackboard.InfoSource(blackboard.Blackboard())
+
+    def test_faults_are_retried(self):
+        self.server.faults = 0.5
+        scheduler = blackboard.RequestScheduler(retries=10, backoff=0.001, seed=0)
+        source = self.source(scheduler)
+        for number in range(10):
+            params = dict(self.PARAMS, artist='Artist %d' % number, track='Song of Artist %d' % number)
+            self.assertEqual(params['track'], source._make_request(params)['track']['name'])
+        self.assertTrue(self.server.injected > 0)
+        self.assertEqual(self.server.injected, scheduler.retried)
+        self.assertEqual(10 + self.server.injected, self.server.requests)
+
+    def test_api_error_once_retries_run_out(self):
+        self.server.faults = 1.0
+        self.server.FAULTS = ('unavailable',)
+        scheduler = blackboard.RequestScheduler(retries=2, backoff=0.001)
+        source = self.source(scheduler)
+        with self.assertRaises(blackboard.APIError) as raised:
+            source._make_request(self.PARAMS)
+        self.assertEqual(503, raised.exception.status)
+        self.assertEqual(2, scheduler.retried)
+        self.assertEqual(3, self.server.requests)
+
+    def test_stalled_requests_time_out_and_are_retried(self):
+        self.server.stalls = 1.0
+        self.server.stall = 0.5
+        scheduler = blackboard.RequestScheduler(retries=1, backoff=0.001)
+        source = self.source(scheduler, timeout=0.05)
+        self.assertRaises(socket.timeout, source._make_request, self.PARAMS)
+        self.assertEqual(1, scheduler.retried)
+        self.assertEqual(2, self.server.requests)
+
+    def test_identical_requests_in_flight_are_coalesced(self):
+        self.server.latency = 0.1
+        scheduler = blackboard.RequestScheduler()
+        source = self.source(scheduler)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(source._make_request(self.PARAMS)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(5, len(results))
+        self.assertEqual(1, self.server.requests)
+        self.assertEqual(4, scheduler.coalesced)
+
+    def test_token_bucket_paces_requests(self):
+        scheduler = blackboard.RequestScheduler(rate=20, burst=1)
+        source = self.source(scheduler)
+        start = time.time()
+        for number in range(5):
+            source._make_request(dict(self.PARAMS, artist='Artist %d' % number))
+        # The first request takes the one token, the other four wait 50 ms each
+        self.assertTrue(time.time() - start >= 0.19)
+        self.assertTrue(scheduler.throttled >= 0.15)
+
+
+class ShardedBatchTest(StubTestCase):
+    SEEDS = ['{"artist": "Artist %d", "track": "Song of Artist %d", "feedback": ["no", "yes"]}' % (number, number)
+             for number in range(4)]
+
+    def setUp(self):
+        StubTestCase.setUp(self)
+        self.shared_workers = blackboard.KnowledgeSource.shared_workers
+        self.directory = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.directory, 'work')
+
+    def tearDown(self):
+        blackboard.KnowledgeSource.shared_workers = self.shared_workers
+        shutil.rmtree(self.directory)
+        StubTestCase.tearDown(self)
+
+    def run_batch(self, seeds):
+        output = StringIO.StringIO()
+        blackboard.run_batch(seeds, output)
+        return output.getvalue()
+
+    def run_sharded(self):
+        output = StringIO.StringIO()
+        blackboard.run_sharded_batch(self.SEEDS, output, self.work_dir, processes=2, shard_size=2)
+        return output.getvalue()
+
+    def test_matches_a_serial_run(self):
+        self.assertEqual(self.run_batch(self.SEEDS), self.run_sharded())
+        self.assertFalse(os.path.exists(self.work_dir))
+
+    def test_refuses_a_directory_with_other_things_in_it(self):
+        os.mkdir(self.work_dir)
+        precious = os.path.join(self.work_dir, 'precious.txt')
+        with open(precious, 'w') as precious_file:
+            precious_file.write('keep me')
+        self.assertRaises(Exception, blackboard.run_sharded_batch, [], StringIO.StringIO(), self.work_dir,
+                          processes=1)
+        self.assertTrue(os.path.exists(precious))
+
+    def job(self):
+        return {'seeds': hashlib.sha1('\n'.join(self.SEEDS)).hexdigest(), 'shard_size': 2}
+
+    def test_only_removes_its_own_files(self):
+        # The job's directory, which something else put a file in while it ran
+        os.mkdir(self.work_dir)
+        blackboard._write_json(os.path.join(self.work_dir, 'job.json'), self.job())
+        with open(os.path.join(self.work_dir, 'notes.txt'), 'w') as notes:
+            notes.write('not the job\'s')
+        self.run_sharded()
+        self.assertEqual(['notes.txt'], os.listdir(self.work_dir))
+
+    def test_resumes_where_it_stopped(self):
+        first, second, third, fourth = [self.run_batch([seed]) for seed in self.SEEDS]
+        # The first shard finished, and the second got through one seed and part of the next
+        os.mkdir(self.work_dir)
+        blackboard._write_json(os.path.join(self.work_dir, 'job.json'), self.job())
+        finished = '{"finished": "before the interruption"}\n'
+        with open(os.path.join(self.work_dir, 'shard-00000.jsonl'), 'w') as shard_file:
+            shard_file.write(finished)
+        with open(os.path.join(self.work_dir, 'shard-00001.partial'), 'w') as shard_file:
+            shard_file.write(third + fourth[:len(fourth) // 2])
+        with open(os.path.join(self.work_dir, 'shard-00001.progress'), 'w') as progress_file:
+            progress_file.write('%d\n' % len(third))
+        self.assertEqual(finished + third + fourth, self.run_sharded())
+        self.assertFalse(os.path.exists(self.work_dir))
+
+
+class JournalTest(StubTestCase):
+    maxDiff = None
+
+    def setUp(self):
+        StubTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        StubTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_restored_session_carries_on_the_same(self):
+        path = os.path.join(self.directory, 'session.snap')
+        session = blackboard.Session(journal=blackboard.BlackboardJournal(path))
+        try:
+            session.seed('Artist 3', 'Song of Artist 3')
+            for round_number, response in enumerate(['no', 'no', 'yes', 'no', 'no', 'no', 'yes', 'no']):
+                session.next()
+                if response == 'yes':
+                    session.like()
+                else:
+                    session.dislike()
+                copy = '%s.%d' % (path, round_number)
+                shutil.copy(path, copy)
+                restored = blackboard.Session.restore(copy)
+                try:
+                    self.assertEqual(session_state(session), session_state(restored))
+                    self.assertEqual(session.next(), restored.next())
+                finally:
+                    restored.close()
+                session.checkpoint()
+        finally:
+            session.close()
+
+    def test_incomplete_frame_is_dropped(self):
+        path = os.path.join(self.directory, 'session.snap')
+        session = blackboard.Session(journal=blackboard.BlackboardJournal(path))
+        try:
+            session.seed('Artist 5', 'Song of Artist 5')
+            session.next()
+            expected = session_state(session)
+            size = os.path.getsize(path)
+            session.dislike()
+        finally:
+            session.close()
+        # A crash part way through writing the last checkpoint
+        with open(path, 'r+b') as journal_file:
+            journal_file.truncate(size + (os.path.getsize(path) - size) // 2)
+        restored = blackboard.Session.restore(path)
+        try:
+            self.assertEqual(expected, session_state(restored))
+        finally:
+            restored.close()
+
+
+if __name__ == '__main__':
+    unittest.main()